@@ -0,0 +1,98 @@
+'''
+Benchmark for the server-side answer check.
+
+Loads trivia.psql into an in-memory database, makes a mix of exact,
+misspelled, reordered and wrong answers for every question and reports the
+cost per answer of a single check, of a batch through /quizzes/answers'
+code path and, for reference, of a textbook dynamic programming edit
+distance.
+
+    python bench_answers.py --answers 20000
+'''
+import argparse
+import random
+import time
+
+from flaskr import create_memory_app
+from flaskr.answers import AnswerForm, check_answers, get_answer_forms, normalize, \
+    MAX_ANSWERS_PER_BATCH
+from models import Question
+
+
+def misspell(answer):
+    characters = list(answer)
+    if len(characters) > 3:
+        position = random.randrange(len(characters) - 1)
+        characters[position], characters[position + 1] = \
+            characters[position + 1], characters[position]
+    return ''.join(characters)
+
+
+def make_answers(questions, count):
+    answers = []
+    for _ in range(count):
+        question = random.choice(questions)
+        kind = random.random()
+        if kind < 0.3:
+            answer = question.answer
+        elif kind < 0.6:
+            answer = misspell(question.answer)
+        elif kind < 0.7:
+            answer = ' '.join(reversed(question.answer.split())).upper()
+        else:
+            answer = random.choice(questions).answer
+        answers.append((question.id, answer))
+    return answers
+
+
+def dynamic_programming_distance(first, second):
+    previous = list(range(len(second) + 1))
+    for row, firstChar in enumerate(first, 1):
+        current = [row]
+        for column, secondChar in enumerate(second, 1):
+            current.append(min(previous[column] + 1, current[column - 1] + 1,
+                               previous[column - 1] + (firstChar != secondChar)))
+        previous = current
+    return previous[-1]
+
+
+def measure(name, count, function):
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+    print('{:>22}: {:8.2f} us per answer'.format(name, elapsed / count * 1e6))
+
+
+def main(arguments):
+    app = create_memory_app({'RATE_LIMITS': {}})
+    with app.app_context():
+        questions = Question.query.all()
+        answers = make_answers(questions, arguments.answers)
+        forms = {question.id: AnswerForm(question.answer) for question in questions}
+        expected = {question.id: normalize(question.answer) for question in questions}
+
+        measure('form precomputation', len(answers),
+                lambda: [AnswerForm(answer) for _, answer in answers])
+        measure('single check', len(answers),
+                lambda: [forms[questionId].score(answer)
+                         for questionId, answer in answers])
+
+        def batches():
+            for start in range(0, len(answers), MAX_ANSWERS_PER_BATCH):
+                check_answers(answers[start:start + MAX_ANSWERS_PER_BATCH])
+        get_answer_forms({question.id for question in questions})
+        measure('batch check', len(answers), batches)
+
+        measure('dp edit distance', len(answers),
+                lambda: [dynamic_programming_distance(
+                    expected[questionId], normalize(answer))
+                    for questionId, answer in answers])
+
+        correct = sum(result['correct'] for result in check_answers(answers[:1000]))
+        print('{:>22}: {} of the first 1000'.format('accepted', correct))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer check benchmark')
+    parser.add_argument('--answers', type=int, default=20000)
+    main(parser.parse_args())
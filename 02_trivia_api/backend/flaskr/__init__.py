@@ -1,31 +1,71 @@
 import os
-from flask import Flask, request, abort, jsonify
+import json
+import click
+from flask import Flask, Response, request, abort, jsonify, stream_with_context, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import random
 from sqlalchemy.sql.expression import func
 
-from models import setup_db, Question, Category
+from models import setup_db, database_path, Question, Category
+from .quiz import draw_questions, MAX_QUESTIONS_PER_ROUND
+from .search import search_questions
+from .ingest import ingest_questions, parse_ndjson
+from .export import export_rows, EXPORT_FORMATS
+from .dedupe import get_duplicate_index, DUPLICATE_THRESHOLD
+from .analytics import AttemptRecorder
+from .stats import question_counts
+from .seed import load_psql_dump
+from .ratelimit import RateLimiter, create_store, DEFAULT_RATE_LIMITS
+from .answers import check_answers, MAX_ANSWERS_PER_BATCH
 
 QUESTIONS_PER_PAGE = 10
+SEED_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'trivia.psql')
 
 
 def paginate(request, selection):
+    perPage = current_app.config['QUESTIONS_PER_PAGE']
     page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    start = (page - 1) * perPage
+    end = start + perPage
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
+    # slicing a query pushes the page down into LIMIT/OFFSET
+    current_questions = [question.format() for question in selection[start:end]]
 
     return current_questions
 
 
 def create_app(test_config=None):
-  # create and configure the app
+    '''
+    create and configure the app
+    test_config is a mapping of config values applied over the defaults, e.g.
+        SQLALCHEMY_DATABASE_URI    database to use, 'sqlite://' for in-memory
+        SQLALCHEMY_ENGINE_OPTIONS  pool options passed to create_engine
+        QUESTIONS_PER_PAGE         page size of the question listings
+        TRIVIA_SEED_FILE           pg_dump (trivia.psql) loaded at startup
+        RATE_LIMITS                token buckets per endpoint, {} disables them
+        RATE_LIMIT_REDIS_URL       share the buckets through Redis
+    '''
     app = Flask(__name__)
+    app.config.from_mapping(
+        SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL', database_path),
+        QUESTIONS_PER_PAGE=QUESTIONS_PER_PAGE,
+        TRIVIA_SEED_FILE=None,
+        RATE_LIMITS=DEFAULT_RATE_LIMITS,
+        RATE_LIMIT_STORE=None,
+        RATE_LIMIT_REDIS_URL=os.environ.get('RATE_LIMIT_REDIS_URL'))
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
 
+    with app.app_context():
+        if app.config['TRIVIA_SEED_FILE']:
+            load_psql_dump(app.config['TRIVIA_SEED_FILE'])
+        get_duplicate_index()
+    app.extensions['attempt_recorder'] = AttemptRecorder(app)
+    RateLimiter(app, create_store(app))
+
     '''
     DONE : Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     '''
@@ -70,13 +110,21 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        '''
+        An endpoint to get every category with its number of questions per
+        difficulty, enough to render the category picker in one call.
+        '''
+        return jsonify(dict(question_counts(), success=True))
+
     @app.route('/questions', methods=['GET'])
     def get_questions():
         '''
         An endpoint to handle GET requests for questions, including pagination (10 questions).
         returns a list of questions, number of total questions, current category, categories.
         '''
-        selection = Question.query.order_by(Question.id).all()
+        selection = Question.query.order_by(Question.id)
         currentPaginatedQuestions = paginate(request, selection)
 
         if (len(currentPaginatedQuestions) == 0):
@@ -88,11 +136,57 @@ def create_app(test_config=None):
         return jsonify({
             'success': True,
             'questions': currentPaginatedQuestions,
-            'total_questions': len(Question.query.all()),
+            'total_questions': Question.query.count(),
             'current_category': [],
             'categories': parsedCategories
         })
 
+    @app.route('/questions/export', methods=['GET'])
+    def export_questions():
+        '''
+        An endpoint to download the whole question bank, optionally limited to
+        one category. rows are streamed from a server-side cursor as NDJSON
+        (default) or CSV.
+        '''
+        exportFormat = request.args.get('format', 'ndjson')
+        categoryId = request.args.get('category', None, type=int)
+        if exportFormat not in EXPORT_FORMATS:
+            abort(400)
+        if categoryId is not None and Category.query.get(categoryId) is None:
+            abort(404)
+
+        mimetype, chunks = EXPORT_FORMATS[exportFormat]
+        return Response(
+            stream_with_context(chunks(export_rows(categoryId))),
+            mimetype=mimetype,
+            headers={'Content-Disposition':
+                     'attachment; filename=questions.{}'.format(exportFormat)})
+
+    @app.route('/questions/duplicates', methods=['GET'])
+    def get_duplicate_questions():
+        '''
+        A GET endpoint reporting clusters of near-duplicate questions.
+        takes an optional similarity threshold between 0 and 1.
+        '''
+        threshold = request.args.get('threshold', DUPLICATE_THRESHOLD, type=float)
+        if threshold <= 0 or threshold > 1:
+            abort(422)
+
+        clusters = get_duplicate_index().clusters(threshold)
+        questions = {question.id: question.format() for question in
+                     Question.query.filter(Question.id.in_(
+                         [questionId for ids, _ in clusters for questionId in ids]))}
+
+        return jsonify({
+            'success': True,
+            'clusters': [{
+                'similarity': score,
+                'questions': [questions[questionId] for questionId in ids
+                              if questionId in questions]
+            } for ids, score in clusters],
+            'total_clusters': len(clusters)
+        })
+
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
         '''
@@ -108,7 +202,7 @@ def create_app(test_config=None):
             return jsonify({
                 'success': True,
                 'question': questionToDelete.id,
-                'total_questions': len(Question.query.all())
+                'total_questions': Question.query.count()
             })
 
         except Exception:
@@ -131,64 +225,134 @@ def create_app(test_config=None):
         newDifficulty = body.get('difficulty', None)
         newCategory = body.get('category', None)
         searchTerm = body.get('searchTerm', None)
+        checkDuplicates = body.get('check_duplicates', False)
 
         try:
             if searchTerm:  # handles search
-                selection = Question.query.order_by(Question.id).filter(
-                    Question.question.ilike('%{}%'.format(search_term)))
-                currentQuestions = paginate(request, selection)
+                page = request.args.get('page', 1, type=int)
+                if not isinstance(searchTerm, str) or page < 1:
+                    abort(422)
+                currentQuestions, totalQuestions = search_questions(
+                    searchTerm, page, app.config['QUESTIONS_PER_PAGE'])
 
                 if (len(currentQuestions) == 0):
                     abort(404)
                 else:
                     return jsonify({
-                        'questions': currentQuestions,
-                        'total_questions': len(Question.query.all()),
-                        'current_category': [(question['category'])
+                        'success': True,
+                        'questions': [question.format()
+                                      for question in currentQuestions],
+                        'total_questions': totalQuestions,
+                        'current_category': [question.category
                                              for question in currentQuestions]
                     })
             else:  # handles creation of new question
+                if checkDuplicates:
+                    duplicates = get_duplicate_index().query(
+                        {'question': newQuestion, 'answer': newAnswer})
+                    if duplicates:
+                        similarities = dict(duplicates)
+                        return jsonify({
+                            'success': False,
+                            'message': 'Duplicate question',
+                            'duplicates': [
+                                dict(question.format(),
+                                     similarity=similarities[question.id])
+                                for question in Question.query.filter(
+                                    Question.id.in_(similarities))]
+                        }), 409
+
                 question = Question(question=newQuestion,
                                     answer=newAnswer,
-                                    difficulty=newDifficulty,
-                                    category=newCategory)
+                                    difficulty=int(newDifficulty),
+                                    category=int(newCategory))
                 question.insert()
 
-                selection = Question.query.order_by(Question.id).all()
+                selection = Question.query.order_by(Question.id)
                 questions = paginate(request, selection)
 
                 return jsonify({
                     'success': True,
                     'questions': questions,
                     'created': question.id,
-                    'total_questions': len(Question.query.all())
+                    'total_questions': Question.query.count()
                 })
 
         except Exception:
             abort(422)
 
+    @app.route('/questions/bulk', methods=['POST'])
+    def create_questions_bulk():
+        '''
+        An endpoint to POST many new questions at once, either as a JSON array or
+        as NDJSON (one question object per line, Content-Type application/x-ndjson).
+        rows are validated one by one and inserted in batched transactions.
+        returns a result per row with the created id or the validation error.
+        '''
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            rows = parse_ndjson(request.stream)
+        else:
+            rows = request.get_json(silent=True)
+            if not isinstance(rows, list):
+                abort(400)
+
+        results = ingest_questions(rows)
+        created = sum(1 for result in results if result['success'])
+
+        return jsonify({
+            'success': True,
+            'created': created,
+            'failed': len(results) - created,
+            'results': results
+        })
+
+    @app.cli.command('load-questions')
+    @click.argument('path', type=click.File('rb'))
+    def load_questions(path):
+        '''
+        Loads questions from a JSON array or an NDJSON file.
+        '''
+        if path.name.endswith('.json'):
+            rows = json.load(path)
+        else:
+            rows = parse_ndjson(path)
+
+        results = ingest_questions(rows)
+        created = sum(1 for result in results if result['success'])
+        for result in results:
+            if not result['success']:
+                click.echo('row {}: {}'.format(result['index'], result['error']),
+                           err=True)
+        click.echo('{} questions created, {} rejected'.format(
+            created, len(results) - created))
+
     @app.route('/questions/search', methods=['POST'])
     def search_question():
+        '''
+        A POST endpoint to search questions by their question and answer text.
+        returns one page of ranked matches and the total number of matches.
+        '''
         body = request.get_json(force=True)
         search = body.get('searchTerm', None)
 
-        try:
-            if search is not None:
-                questions = Question.query.order_by(Question.id)\
-                    .filter(Question.question.ilike('%{}%'.format(search)))
-                current_questions = paginate(request, questions)
-
-                if len(questions.all()) != 0:
-                    return jsonify({
-                        'success': True,
-                        'questions': current_questions,
-                        'total_questions': len(questions.all())
-                    })
+        if search is None:
             abort(404)
-        except Exception as ex:
-            print(2, ex)
+
+        page = request.args.get('page', 1, type=int)
+        if not isinstance(search, str) or page < 1:
+            abort(422)
+        currentQuestions, totalQuestions = search_questions(
+            search, page, app.config['QUESTIONS_PER_PAGE'])
+
+        if len(currentQuestions) == 0:
             abort(404)
 
+        return jsonify({
+            'success': True,
+            'questions': [question.format() for question in currentQuestions],
+            'total_questions': totalQuestions
+        })
+
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
     def get_questions_categories(category_id):
         '''
@@ -200,7 +364,7 @@ def create_app(test_config=None):
             abort(404)
 
         selection = Question.query.filter(
-            Question.category == category_id).all()
+            Question.category == category_id).order_by(Question.id)
         currentQuestions = paginate(request, selection)
         if (len(currentQuestions) == 0):
             abort(404)
@@ -208,7 +372,7 @@ def create_app(test_config=None):
         return jsonify({
             'success': True,
             'questions': currentQuestions,
-            'total_questions': len(Question.query.all()),
+            'total_questions': Question.query.count(),
             'current_category': currentCategory.format()
         })
 
@@ -225,53 +389,168 @@ def create_app(test_config=None):
 #        i changes the entire previous implementations entirely as it was
 #        going to be a mess to fix because of all the nested if statements
         try:
-            if id == 0:  # id is 0 in case of all is chosen
-                questions = Question.query.filter(~Question.id.in_(previousQuestions)).all()
-
-                if len(questions) == 0 :
-                    return jsonify({
-                       "previousQuestions": []})
+            # id is 0 in case of all is chosen
+            questions = draw_questions(int(id), previousQuestions)
 
-                randomQuestion = random.choice(questions)
+            if len(questions) == 0:
+                return jsonify({
+                    "previousQuestions": []})
 
-                quizData = {
-                    'id': randomQuestion.id,
-                    'question': randomQuestion.question,
-                    'answer': randomQuestion.answer,
-                    'category': randomQuestion.category,
-                    'difficulty': randomQuestion.difficulty
-                }
+            return jsonify({
+                "question": questions[0].format(),
+                "previousQuestions": []})
+        except Exception:
+            app.logger.exception('drawing a quiz question failed')
+            abort(422)
 
-                return jsonify({
-                    "question": quizData,
-                    "previousQuestions": []
-                })
+    @app.route('/quizzes/batch', methods=['POST'])
+    def get_quizzes_batch():
+        '''
+        A POST endpoint to get a whole round of quiz questions at once.
+        takes category, previous questions, the number of questions and optionally
+        one or more difficulty levels to spread the round over.
+        returns up to `count` distinct random questions drawn with a single query.
+        '''
+        body = request.get_json()
+        if body is None:
+            abort(400)
 
+        try:
+            categoryId = int(body.get('quiz_category', {}).get('id', 0))
+            previousQuestions = [int(questionId) for questionId
+                                 in body.get('previous_questions', [])]
+            count = int(body.get('count', 5))
+            difficulty = body.get('difficulty', None)
+            if difficulty is None:
+                difficulties = None
+            elif isinstance(difficulty, list):
+                difficulties = [int(level) for level in difficulty]
             else:
-                questions = Question.query.filter(
-                    Question.category == id,
-                    ~Question.id.in_(previousQuestions)).all()
+                difficulties = [int(difficulty)]
+        except (TypeError, ValueError, AttributeError):
+            abort(422)
 
-                if len(questions) == 0 :
-                    return jsonify({
-                       "previousQuestions": []})
+        if count < 1 or count > MAX_QUESTIONS_PER_ROUND:
+            abort(422)
 
-                randomQuestion = random.choice(questions)
+        questions = draw_questions(categoryId, previousQuestions, count,
+                                   difficulties)
 
-                quizData = {
-                    'id': randomQuestion.id,
-                    'question': randomQuestion.question,
-                    'answer': randomQuestion.answer,
-                    'category': randomQuestion.category,
-                    'difficulty': randomQuestion.difficulty}
+        return jsonify({
+            'success': True,
+            'questions': [question.format() for question in questions],
+            'total_questions': len(questions)
+        })
 
-                return jsonify({
-                    "question": quizData,
-                    "previousQuestions": []})
-        except BaseException  as ex:
-            print(4,ex)
+    def parse_answer(body):
+        answer = body['answer']
+        if not isinstance(answer, str):
+            raise ValueError('answer must be a string')
+        return int(body['question_id']), answer
+
+    @app.route('/quizzes/answer', methods=['POST'])
+    def check_quiz_answer():
+        '''
+        A POST endpoint to check the answer given to a quiz question.
+        takes the question id and the answer, which is compared to the expected
+        answer ignoring case, accents, punctuation, word order and small typos.
+        returns whether it is correct, its similarity score and the expected answer.
+        '''
+        body = request.get_json()
+        if body is None:
+            abort(400)
+
+        try:
+            attempt = parse_answer(body)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            abort(422)
+
+        result = check_answers([attempt])[0]
+        if result is None:
+            abort(404)
+
+        return jsonify(dict(result, success=True))
+
+    @app.route('/quizzes/answers', methods=['POST'])
+    def check_quiz_answers():
+        '''
+        A POST endpoint to check many answers at once, e.g. a whole round or a
+        whole room. takes a list of question ids and answers.
+        returns one result per answer in the same order, unknown questions are
+        reported as not found instead of failing the batch.
+        '''
+        body = request.get_json()
+        if body is None:
+            abort(400)
+
+        try:
+            attempts = [parse_answer(attempt) for attempt in body['answers']]
+        except (KeyError, TypeError, ValueError, AttributeError):
             abort(422)
 
+        if len(attempts) > MAX_ANSWERS_PER_BATCH:
+            abort(422)
+
+        results = check_answers(attempts)
+
+        return jsonify({
+            'success': True,
+            'results': [result or {
+                'question_id': questionId,
+                'error': 'question not found'
+            } for (questionId, _), result in zip(attempts, results)]
+        })
+
+    @app.route('/quizzes/attempts', methods=['POST'])
+    def record_quiz_attempts():
+        '''
+        A POST endpoint to record answers given during a quiz.
+        takes one attempt or a list of attempts with the question id, whether the
+        answer was correct and optionally the time taken to answer.
+        attempts are buffered and written in batches in the background.
+        '''
+        body = request.get_json()
+        if body is None:
+            abort(400)
+        if isinstance(body, dict):
+            body = body.get('attempts', [body])
+
+        try:
+            attempts = []
+            for attempt in body:
+                latency = attempt.get('latency_ms', None)
+                if not isinstance(attempt['correct'], bool):
+                    raise ValueError('correct must be a boolean')
+                attempts.append({
+                    'question_id': int(attempt['question_id']),
+                    'correct': attempt['correct'],
+                    'latency_ms': None if latency is None else int(latency)
+                })
+                if attempts[-1]['latency_ms'] is not None and \
+                        attempts[-1]['latency_ms'] < 0:
+                    raise ValueError('latency_ms must not be negative')
+        except (KeyError, TypeError, ValueError, AttributeError):
+            abort(422)
+
+        accepted = app.extensions['attempt_recorder'].record(attempts)
+
+        return jsonify({
+            'success': True,
+            'accepted': accepted
+        }), 202
+
+    @app.route('/quizzes/stats', methods=['GET'])
+    def get_quiz_stats():
+        '''
+        A GET endpoint to get answer accuracy per category and per question.
+        aggregated from the attempts table, cached for a few seconds.
+        takes an optional category id to limit the result to one category.
+        '''
+        categoryId = request.args.get('category', None, type=int)
+        stats = app.extensions['attempt_recorder'].stats(categoryId)
+
+        return jsonify(dict(stats, success=True))
+
     @app.errorhandler(422)
     def unprocessable_error_handler(error):
         '''
@@ -323,3 +602,17 @@ def create_app(test_config=None):
         }), 500
 
     return app
+
+
+def create_memory_app(test_config=None):
+    '''
+    create_app on a fresh in-memory SQLite database seeded from trivia.psql,
+    with test_config applied on top. used by the tests, the room load test
+    and the answer benchmark
+    '''
+    config = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'TRIVIA_SEED_FILE': SEED_FILE
+    }
+    config.update(test_config or {})
+    return create_app(config)
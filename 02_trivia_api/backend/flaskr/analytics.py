@@ -0,0 +1,231 @@
+import atexit
+import threading
+import time
+from collections import deque, defaultdict
+from contextlib import nullcontext
+from datetime import datetime
+
+from flask import has_app_context
+from sqlalchemy import Integer
+from sqlalchemy.sql.expression import func, cast
+
+from models import db, Question, QuizAttempt
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+MAX_BUFFERED_ATTEMPTS = 100000
+MIN_ATTEMPTS_FOR_DIFFICULTY = 20
+# attempts written by other workers show up after at most this many seconds
+STATS_TTL = 10
+
+
+class AttemptStats:
+    '''
+    running totals for a question or a category.
+    '''
+    __slots__ = ('attempts', 'correct', 'latencyTotal', 'latencyCount')
+
+    def __init__(self):
+        self.attempts = 0
+        self.correct = 0
+        self.latencyTotal = 0
+        self.latencyCount = 0
+
+    def add(self, attempts, correct, latencyTotal, latencyCount):
+        self.attempts += attempts
+        self.correct += correct
+        self.latencyTotal += latencyTotal
+        self.latencyCount += latencyCount
+
+    def format(self):
+        accuracy = self.correct / self.attempts if self.attempts else None
+        if accuracy is not None and self.attempts >= MIN_ATTEMPTS_FOR_DIFFICULTY:
+            # 80%+ correct suggests difficulty 1, under 20% suggests 5
+            suggestedDifficulty = 5 - min(4, int(accuracy * 5))
+        else:
+            suggestedDifficulty = None
+        return {
+            'attempts': self.attempts,
+            'correct': self.correct,
+            'accuracy': accuracy,
+            'average_latency_ms': (self.latencyTotal / self.latencyCount
+                                   if self.latencyCount else None),
+            'suggested_difficulty': suggestedDifficulty
+        }
+
+
+class AttemptRecorder:
+    '''
+    Write-behind recorder for quiz attempts.
+
+    record() only appends to an in-memory buffer. A background thread writes
+    the buffer every FLUSH_INTERVAL seconds (or as soon as BATCH_SIZE attempts
+    are waiting) with one lookup query and one multi-row insert.
+
+    stats() aggregates the attempts table with one grouped query and keeps
+    the totals for STATS_TTL seconds, so every worker serves the same
+    numbers within that delay. A write from this process drops them at once.
+
+    At most MAX_BUFFERED_ATTEMPTS attempts wait in the buffer; while the
+    database is unreachable newer attempts are dropped and logged. stop()
+    ends the thread, create_app's callers stop it when they drop the app.
+    '''
+
+    def __init__(self, app, batchSize=BATCH_SIZE, flushInterval=FLUSH_INTERVAL):
+        self.app = app
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.buffer = deque()
+        self.wakeup = threading.Event()
+        self.flushLock = threading.Lock()
+        self.statsLock = threading.Lock()
+        # (expires, questionStats, categoryStats, questionCategories)
+        self.totals = None
+        # bumped by every write, keeps a load that raced it from being cached
+        self.writes = 0
+        self.worker = None
+        self.stopped = threading.Event()
+
+    def record(self, attempts):
+        '''
+        attempts are dicts with question_id, correct and optionally latency_ms.
+        returns the number of attempts buffered, the rest did not fit.
+        '''
+        recordedAt = datetime.utcnow()
+        accepted = attempts[:max(0, MAX_BUFFERED_ATTEMPTS - len(self.buffer))]
+        for attempt in accepted:
+            self.buffer.append(dict(attempt, created_at=recordedAt))
+        if len(accepted) < len(attempts):
+            self.app.logger.warning('quiz attempt buffer full, dropped %d attempts',
+                                    len(attempts) - len(accepted))
+        if self.worker is None:
+            self.start()
+        if len(self.buffer) >= self.batchSize:
+            self.wakeup.set()
+        return len(accepted)
+
+    def start(self):
+        with self.flushLock:
+            if self.worker is not None or self.stopped.is_set():
+                return
+            self.worker = threading.Thread(target=self.run, daemon=True,
+                                           name='quiz-attempt-writer')
+            self.worker.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        '''
+        ends the background thread after a last flush. attempts recorded
+        afterwards stay in the buffer until flush() is called.
+        '''
+        self.stopped.set()
+        worker = self.worker
+        if worker is None:
+            return
+        atexit.unregister(self.stop)
+        self.wakeup.set()
+        worker.join()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('quiz attempts flush failed')
+            if self.stopped.is_set():
+                return
+
+    def flush(self):
+        '''
+        writes everything buffered so far. returns the number of rows written.
+        '''
+        with self.flushLock, self.app_context():
+            written = 0
+            while self.buffer:
+                batch = []
+                while self.buffer and len(batch) < self.batchSize:
+                    batch.append(self.buffer.popleft())
+                try:
+                    written += self.write(batch)
+                except Exception:
+                    db.session.rollback()
+                    # put the batch back in front, as much of it as fits
+                    kept = batch[:max(0, MAX_BUFFERED_ATTEMPTS - len(self.buffer))]
+                    self.buffer.extendleft(reversed(kept))
+                    if len(kept) < len(batch):
+                        self.app.logger.warning(
+                            'quiz attempt buffer full, dropped %d attempts',
+                            len(batch) - len(kept))
+                    raise
+            return written
+
+    def app_context(self):
+        '''
+        the worker thread needs its own app context, request handlers already
+        have one (and a nested one would close their session on teardown).
+        '''
+        return nullcontext() if has_app_context() else self.app.app_context()
+
+    def write(self, batch):
+        questionIds = {attempt['question_id'] for attempt in batch}
+        categories = dict(db.session.query(Question.id, Question.category)
+                          .filter(Question.id.in_(questionIds)))
+        # attempts for deleted questions are dropped instead of failing the batch
+        batch = [attempt for attempt in batch if attempt['question_id'] in categories]
+        if not batch:
+            return 0
+
+        db.session.bulk_insert_mappings(QuizAttempt, batch)
+        db.session.commit()
+
+        with self.statsLock:
+            self.totals = None
+            self.writes += 1
+        return len(batch)
+
+    def load(self):
+        '''
+        the totals per question and category of the attempts stored, from
+        one grouped query.
+        '''
+        questionStats = defaultdict(AttemptStats)
+        categoryStats = defaultdict(AttemptStats)
+        questionCategories = {}
+        rows = db.session.query(
+            QuizAttempt.question_id,
+            Question.category,
+            func.count(QuizAttempt.id),
+            func.sum(cast(QuizAttempt.correct, Integer)),
+            func.sum(QuizAttempt.latency_ms),
+            func.count(QuizAttempt.latency_ms))\
+            .join(Question, Question.id == QuizAttempt.question_id)\
+            .group_by(QuizAttempt.question_id, Question.category)
+        for questionId, category, attempts, correct, latencyTotal, latencyCount in rows:
+            totals = (attempts, correct or 0, latencyTotal or 0, latencyCount)
+            questionStats[questionId].add(*totals)
+            categoryStats[category].add(*totals)
+            questionCategories[questionId] = category
+        return (time.monotonic() + STATS_TTL, questionStats, categoryStats,
+                questionCategories)
+
+    def stats(self, categoryId=None):
+        with self.statsLock:
+            totals, writes = self.totals, self.writes
+        if totals is None or totals[0] <= time.monotonic():
+            with self.app_context():
+                totals = self.load()
+            with self.statsLock:
+                if self.writes == writes:
+                    self.totals = totals
+        expires, questionStats, categoryStats, questionCategories = totals
+        return {
+            'categories': {category: stats.format() for category, stats
+                           in categoryStats.items()
+                           if categoryId is None or category == categoryId},
+            'questions': {questionId: stats.format() for questionId, stats
+                          in questionStats.items()
+                          if categoryId is None or
+                          questionCategories.get(questionId) == categoryId}
+        }
@@ -0,0 +1,166 @@
+import re
+import unicodedata
+
+from flask import current_app
+
+from models import db, Question, on_questions_committed
+
+ANSWER_THRESHOLD = 0.8
+MAX_ANSWER_LENGTH = 200
+MAX_ANSWERS_PER_BATCH = 1000
+ARTICLES = {'a', 'an', 'the'}
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    '''
+    the comparable form of an answer: accents stripped, case folded,
+    punctuation turned into spaces and leading articles dropped, so
+    "The Liver" and "liver" or "Édith Piaf" and "edith piaf." are equal.
+    '''
+    text = unicodedata.normalize('NFKD', text[:MAX_ANSWER_LENGTH])
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    tokens = NON_WORD_PATTERN.sub(' ', text.casefold()).split()
+    while len(tokens) > 1 and tokens[0] in ARTICLES:
+        tokens.pop(0)
+    return ' '.join(tokens)
+
+
+def match_masks(pattern):
+    '''
+    bit mask of the positions of every character of pattern.
+    '''
+    masks = {}
+    for position, char in enumerate(pattern):
+        masks[char] = masks.get(char, 0) | (1 << position)
+    return masks
+
+
+def edit_distance(masks, length, text):
+    '''
+    Levenshtein distance between a pattern, given by its match_masks and
+    length, and text.
+
+    Bit-parallel (Myers, in Hyyrö's formulation): a whole column of the
+    dynamic programming table is kept as two bit vectors of vertical +1/-1
+    steps and advanced with a handful of integer operations per character
+    of text, instead of one cell at a time.
+    '''
+    if not length:
+        return len(text)
+    full = (1 << length) - 1
+    last = 1 << (length - 1)
+    positive, negative = full, 0
+    distance = length
+    for char in text:
+        equal = masks.get(char, 0)
+        vertical = equal | negative
+        horizontal = (((equal & positive) + positive) ^ positive) | equal
+        up = negative | (~(horizontal | positive) & full)
+        down = positive & horizontal
+        if up & last:
+            distance += 1
+        elif down & last:
+            distance -= 1
+        up = ((up << 1) | 1) & full
+        down = (down << 1) & full
+        positive = down | (~(vertical | up) & full)
+        negative = up & vertical
+    return distance
+
+
+class AnswerForm:
+    '''
+    The precomputed forms of a question's answer: normalized text, its
+    tokens in sorted order (so word order does not matter) and the bit
+    masks of both, built once and reused for every answer checked.
+    '''
+
+    __slots__ = ('answer', 'text', 'sortedText', 'numbers', 'masks', 'sortedMasks')
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.text = normalize(answer)
+        tokens = self.text.split()
+        self.sortedText = ' '.join(sorted(tokens))
+        self.numbers = {token for token in tokens if token.isdigit()}
+        self.masks = match_masks(self.text)
+        self.sortedMasks = match_masks(self.sortedText)
+
+    def score(self, answer):
+        '''
+        similarity of answer to the expected answer, from 0 to 1: one minus
+        the edit distance relative to the longer text, compared as written
+        and with sorted tokens. numbers must be given exactly, a year off by
+        one is wrong however close it looks.
+        '''
+        given = normalize(answer)
+        if given == self.text:
+            return 1.0
+        tokens = given.split()
+        if self.numbers != {token for token in tokens if token.isdigit()}:
+            return 0.0
+        longest = max(len(given), len(self.text))
+        if not longest:
+            return 0.0
+        distance = edit_distance(self.masks, len(self.text), given)
+        if distance and (len(tokens) > 1 or self.sortedText != self.text):
+            sortedGiven = ' '.join(sorted(tokens))
+            distance = min(distance, edit_distance(
+                self.sortedMasks, len(self.sortedText), sortedGiven))
+        return 1 - distance / longest
+
+    def matches(self, answer):
+        return self.score(answer) >= ANSWER_THRESHOLD
+
+
+def get_answer_forms(questionIds):
+    '''
+    answer forms of the given questions, missing ones are loaded with one
+    query and cached on the app until the question changes.
+    '''
+    forms = current_app.extensions.setdefault('answer_forms', {})
+    missing = {questionId for questionId in questionIds if questionId not in forms}
+    if missing:
+        rows = db.session.query(Question.id, Question.answer)\
+            .filter(Question.id.in_(missing))
+        for questionId, answer in rows:
+            forms[questionId] = AnswerForm(answer or '')
+    return {questionId: forms[questionId]
+            for questionId in questionIds if questionId in forms}
+
+
+def check_answers(attempts):
+    '''
+    scores a list of (question id, answer) pairs. returns one result per
+    attempt in order, None for unknown questions. all questions of the
+    batch are looked up together, each form serves all its answers and
+    answers repeated within the batch are scored once.
+    '''
+    forms = get_answer_forms({questionId for questionId, _ in attempts})
+    scores = {}
+    results = []
+    for questionId, answer in attempts:
+        form = forms.get(questionId)
+        if form is None:
+            results.append(None)
+            continue
+        score = scores.get((questionId, answer))
+        if score is None:
+            score = scores[questionId, answer] = form.score(answer)
+        results.append({
+            'question_id': questionId,
+            'correct': score >= ANSWER_THRESHOLD,
+            'score': round(score, 3),
+            'answer': form.answer
+        })
+    return results
+
+
+@on_questions_committed
+def sync_answer_forms(inserted, updated, deleted):
+    forms = current_app.extensions.get('answer_forms')
+    if forms is None:
+        return
+    for question in updated + deleted:
+        forms.pop(question['id'], None)
@@ -0,0 +1,228 @@
+import re
+import zlib
+from array import array
+from collections import defaultdict
+
+from flask import current_app
+
+from models import db, Question, on_questions_committed
+
+SHINGLE_SIZE = 4
+BIN_BITS = 6
+NUM_PERMUTATIONS = 1 << BIN_BITS
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+VALUE_BITS = 32 - BIN_BITS
+VALUE_MASK = (1 << VALUE_BITS) - 1
+EMPTY = 0xffffffff
+DUPLICATE_THRESHOLD = 0.7
+# buckets larger than this are compared against a few representatives
+# instead of pair by pair
+MAX_BUCKET_PAIRS = 64
+
+
+def shingles(question):
+    text = ' '.join(re.findall(r'\w+', '{} {}'.format(
+        question['question'] or '', question['answer'] or '').lower()))
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def signature(question):
+    '''
+    MinHash signature of the character shingles of question and answer.
+
+    Uses one-permutation hashing: every shingle is hashed once, the top bits
+    pick one of NUM_PERMUTATIONS bins and each bin keeps its minimum. Empty
+    bins borrow the value of the next filled bin, offset by the distance, so
+    two questions agree on a slot with probability equal to their Jaccard
+    similarity, at the cost of one hash per shingle.
+    '''
+    bins = [EMPTY] * NUM_PERMUTATIONS
+    for shingle in shingles(question):
+        hashed = (zlib.crc32(shingle.encode('utf-8')) * 0x9E3779B1) & 0xffffffff
+        slot, value = hashed >> VALUE_BITS, hashed & VALUE_MASK
+        if value < bins[slot]:
+            bins[slot] = value
+
+    # walk twice around the ring backwards, remembering the last filled bin
+    original = bins[:]
+    donor = None
+    for step in range(2 * NUM_PERMUTATIONS - 1, -1, -1):
+        slot = step % NUM_PERMUTATIONS
+        if original[slot] != EMPTY:
+            donor = step
+        elif donor is not None and step < NUM_PERMUTATIONS:
+            bins[slot] = original[donor % NUM_PERMUTATIONS] + \
+                ((donor - step) << VALUE_BITS)
+    return array('I', bins)
+
+
+def similarity(first, second):
+    return sum(1 for a, b in zip(first, second) if a == b) / NUM_PERMUTATIONS
+
+
+class DisjointSet:
+    '''
+    union-find over question ids with path compression and union by rank.
+    '''
+
+    def __init__(self):
+        self.parents = {}
+        self.ranks = {}
+
+    def find(self, questionId):
+        root = questionId
+        while self.parents.get(root, root) != root:
+            root = self.parents[root]
+        while questionId != root:
+            self.parents[questionId], questionId = root, self.parents[questionId]
+        return root
+
+    def union(self, first, second):
+        '''
+        joins the sets of two roots, returns the root of the joined set.
+        '''
+        if self.ranks.get(first, 0) < self.ranks.get(second, 0):
+            first, second = second, first
+        self.parents[second] = first
+        self.parents.setdefault(first, first)
+        if self.ranks.get(first, 0) == self.ranks.get(second, 0):
+            self.ranks[first] = self.ranks.get(first, 0) + 1
+        return first
+
+
+class DuplicateIndex:
+    '''
+    LSH index over MinHash signatures: the signature is cut into BANDS bands
+    of ROWS slots and questions sharing any band land in the same bucket.
+    a lookup only compares against the questions in its buckets, so it stays
+    sub-linear in the size of the bank.
+
+    the cluster report of the last threshold asked for is kept until the
+    next add() or remove().
+    '''
+
+    def __init__(self):
+        self.signatures = {}
+        self.buckets = [defaultdict(set) for _ in range(BANDS)]
+        self.report = None
+
+    @staticmethod
+    def band_keys(questionSignature):
+        return [hash(questionSignature[band * ROWS:(band + 1) * ROWS].tobytes())
+                for band in range(BANDS)]
+
+    def add(self, question):
+        self.remove(question['id'])
+        questionSignature = signature(question)
+        self.signatures[question['id']] = questionSignature
+        for band, key in enumerate(self.band_keys(questionSignature)):
+            self.buckets[band][key].add(question['id'])
+        self.report = None
+
+    def remove(self, questionId):
+        questionSignature = self.signatures.pop(questionId, None)
+        if questionSignature is None:
+            return
+        for band, key in enumerate(self.band_keys(questionSignature)):
+            bucket = self.buckets[band][key]
+            bucket.discard(questionId)
+            if not bucket:
+                del self.buckets[band][key]
+        self.report = None
+
+    def query(self, question, threshold=DUPLICATE_THRESHOLD):
+        '''
+        returns (question id, estimated similarity) pairs of the indexed
+        questions similar to `question`, most similar first.
+        '''
+        questionSignature = signature(question)
+        candidates = set()
+        for band, key in enumerate(self.band_keys(questionSignature)):
+            candidates.update(self.buckets[band].get(key, ()))
+        candidates.discard(question.get('id'))
+
+        matches = [(candidate, similarity(questionSignature,
+                                          self.signatures[candidate]))
+                   for candidate in candidates]
+        return sorted([match for match in matches if match[1] >= threshold],
+                      key=lambda match: (-match[1], match[0]))
+
+    def clusters(self, threshold=DUPLICATE_THRESHOLD):
+        '''
+        groups the indexed questions into clusters of near duplicates.
+        returns (sorted question ids, highest similarity of the pairs that
+        joined it) per cluster.
+
+        pairs already in the same cluster are not compared again. in a
+        bucket of more than MAX_BUCKET_PAIRS questions each question is only
+        compared against up to MAX_BUCKET_PAIRS representatives of the
+        clusters found in it, so a hot bucket costs linear time; a question
+        like none of them is not paired inside that bucket.
+        '''
+        report = self.report
+        if report is not None and report[0] == threshold:
+            return report[1]
+
+        clusters = DisjointSet()
+        best = defaultdict(float)
+
+        def join(first, second):
+            firstRoot, secondRoot = clusters.find(first), clusters.find(second)
+            if firstRoot == secondRoot:
+                return True
+            score = similarity(self.signatures[first], self.signatures[second])
+            if score < threshold:
+                return False
+            root = clusters.union(firstRoot, secondRoot)
+            best[root] = max(best.pop(firstRoot, 0), best.pop(secondRoot, 0), score)
+            return True
+
+        for bands in self.buckets:
+            for bucket in bands.values():
+                if len(bucket) < 2:
+                    continue
+                members = sorted(bucket)
+                if len(members) <= MAX_BUCKET_PAIRS:
+                    for position, first in enumerate(members):
+                        for second in members[position + 1:]:
+                            join(first, second)
+                    continue
+                representatives = []
+                for member in members:
+                    if not any(join(representative, member)
+                               for representative in representatives) and \
+                            len(representatives) < MAX_BUCKET_PAIRS:
+                        representatives.append(member)
+
+        groups = defaultdict(list)
+        for questionId in clusters.parents:
+            groups[clusters.find(questionId)].append(questionId)
+        clustersFound = sorted((sorted(members), best[root])
+                               for root, members in groups.items())
+        self.report = (threshold, clustersFound)
+        return clustersFound
+
+
+def get_duplicate_index():
+    index = current_app.extensions.get('duplicate_index')
+    if index is None:
+        index = DuplicateIndex()
+        rows = db.session.query(Question.id, Question.question, Question.answer)
+        for row in rows:
+            index.add(row._asdict())
+        current_app.extensions['duplicate_index'] = index
+    return index
+
+
+@on_questions_committed
+def sync_duplicate_index(inserted, updated, deleted):
+    index = current_app.extensions.get('duplicate_index')
+    if index is None:
+        return
+    for question in deleted:
+        index.remove(question['id'])
+    for question in inserted + updated:
+        index.add(question)
@@ -0,0 +1,52 @@
+import csv
+import io
+import json
+
+from models import db, Question
+
+EXPORT_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+CHUNK_ROWS = 1000
+
+
+def export_rows(categoryId=None):
+    '''
+    yields the questions as plain tuples, ordered by id. the rows come from a
+    server-side cursor in chunks of CHUNK_ROWS, so memory stays flat however
+    large the table is.
+    '''
+    query = db.session.query(*[getattr(Question, field) for field in EXPORT_FIELDS])
+    if categoryId is not None:
+        query = query.filter(Question.category == categoryId)
+    return query.order_by(Question.id)\
+        .execution_options(stream_results=True)\
+        .yield_per(CHUNK_ROWS)
+
+
+def ndjson_chunks(rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(EXPORT_FIELDS, row))))
+        if len(lines) >= CHUNK_ROWS:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_chunks),
+    'csv': ('text/csv', csv_chunks)
+}
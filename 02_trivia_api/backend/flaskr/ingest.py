@@ -0,0 +1,96 @@
+import json
+
+from models import db, Question, Category
+
+BATCH_SIZE = 500
+
+
+def parse_ndjson(lines):
+    '''
+    yields one row per non-empty line. lines that are not valid JSON are
+    passed on as the raw text so they are reported as row errors.
+    '''
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line
+
+
+def validate_question(row, categoryIds):
+    '''
+    returns the keyword arguments for a new Question, or an error message.
+    '''
+    if not isinstance(row, dict):
+        return None, 'row is not a JSON object'
+
+    question = row.get('question')
+    answer = row.get('answer')
+    if not isinstance(question, str) or not question.strip():
+        return None, 'question is required'
+    if not isinstance(answer, str) or not answer.strip():
+        return None, 'answer is required'
+
+    try:
+        difficulty = int(row.get('difficulty'))
+        category = int(row.get('category'))
+    except (TypeError, ValueError):
+        return None, 'difficulty and category must be integers'
+    if difficulty < 1 or difficulty > 5:
+        return None, 'difficulty must be between 1 and 5'
+    if category not in categoryIds:
+        return None, 'unknown category {}'.format(category)
+
+    return {
+        'question': question.strip(),
+        'answer': answer.strip(),
+        'difficulty': difficulty,
+        'category': category
+    }, None
+
+
+def ingest_questions(rows, batchSize=BATCH_SIZE):
+    '''
+    Validates and inserts questions, committing once per batch.
+    rows may be any iterable (a list or a lazily parsed stream).
+    returns one result per row, in input order: the id of the created
+    question or the reason the row was rejected.
+    '''
+    categoryIds = {categoryId for (categoryId,) in db.session.query(Category.id)}
+    results = []
+    batch = []
+
+    def flush():
+        questions = [Question(**fields) for _, fields in batch]
+        try:
+            db.session.add_all(questions)
+            db.session.flush()
+            ids = [question.id for question in questions]
+            db.session.commit()
+        except Exception as ex:
+            db.session.rollback()
+            results.extend({'index': index, 'success': False, 'error': str(ex)}
+                           for index, _ in batch)
+        else:
+            results.extend({'index': index, 'success': True, 'id': questionId}
+                           for (index, _), questionId in zip(batch, ids))
+        del batch[:]
+
+    for index, row in enumerate(rows):
+        fields, error = validate_question(row, categoryIds)
+        if error:
+            results.append({'index': index, 'success': False, 'error': error})
+            continue
+        batch.append((index, fields))
+        if len(batch) >= batchSize:
+            flush()
+    if batch:
+        flush()
+
+    results.sort(key=lambda result: result['index'])
+    return results
@@ -0,0 +1,37 @@
+from sqlalchemy.sql.expression import func
+
+from models import Question
+
+MAX_QUESTIONS_PER_ROUND = 50
+
+
+def draw_questions(category_id=0, previous_questions=(), count=1,
+                   difficulties=None):
+    '''
+    Draws up to `count` distinct random questions with a single query.
+
+    category_id 0 means all categories. When `difficulties` is given the
+    draw is stratified: questions are ranked randomly inside each difficulty
+    and picked round-robin, so every level is represented before any level
+    gets a second question.
+    '''
+    query = Question.query
+    if category_id:
+        query = query.filter(Question.category == category_id)
+    if previous_questions:
+        query = query.filter(~Question.id.in_(previous_questions))
+
+    if not difficulties:
+        return query.order_by(func.random()).limit(count).all()
+
+    ranked = query.filter(Question.difficulty.in_(difficulties))\
+        .with_entities(
+            Question.id.label('id'),
+            func.row_number().over(
+                partition_by=Question.difficulty,
+                order_by=func.random()).label('rank'))\
+        .subquery()
+
+    return Question.query.join(ranked, Question.id == ranked.c.id)\
+        .order_by(ranked.c.rank, func.random())\
+        .limit(count).all()
@@ -0,0 +1,161 @@
+import math
+import threading
+import time
+
+from flask import request, jsonify
+
+'''
+default limits as (tokens per second, burst size), per client and for the
+route as a whole. endpoints not listed here are not limited.
+'''
+DEFAULT_RATE_LIMITS = {
+    'get_quizzes': {'client': (5, 20), 'route': (200, 400)},
+    'get_quizzes_batch': {'client': (1, 5), 'route': (50, 100)},
+    'search_question': {'client': (5, 20), 'route': (200, 400)}
+}
+SWEEP_EVERY = 10000
+
+
+class MemoryBucketStore:
+    '''
+    Token buckets kept in process memory, shared by the threads of a worker.
+    '''
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def consume(self, buckets):
+        '''
+        takes one token from each of `buckets`, a list of (key, rate,
+        capacity) where the bucket `key` is refilled at `rate` tokens per
+        second up to `capacity`. tokens are taken from all of them or from
+        none. returns 0 when they were taken, otherwise the seconds until
+        every bucket has one.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            levels = []
+            wait = 0
+            for key, rate, capacity in buckets:
+                tokens, updated = self.buckets.get(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                levels.append((key, tokens))
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            for key, tokens in levels:
+                self.buckets[key] = (tokens if wait else tokens - 1, now)
+
+            self.calls += 1
+            if self.calls % SWEEP_EVERY == 0:
+                self.sweep(now)
+        return wait
+
+    def sweep(self, now):
+        '''
+        forgets clients idle for an hour, their buckets have long refilled
+        and behave exactly like missing ones.
+        '''
+        idle = [key for key, (tokens, updated) in self.buckets.items()
+                if now - updated > 3600]
+        for key in idle:
+            del self.buckets[key]
+
+
+class RedisBucketStore:
+    '''
+    Token buckets kept in Redis (or anything speaking its EVAL command), so
+    every worker and host shares the same limits. `client` is e.g. a
+    redis.Redis instance.
+    '''
+
+    SCRIPT = '''
+        local now = tonumber(ARGV[1])
+        local levels = {}
+        local wait = 0
+        for i, key in ipairs(KEYS) do
+            local rate = tonumber(ARGV[2 * i])
+            local capacity = tonumber(ARGV[2 * i + 1])
+            local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+            local tokens = tonumber(bucket[1]) or capacity
+            local updated = tonumber(bucket[2]) or now
+            tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+            levels[i] = tokens
+            if tokens < 1 then
+                wait = math.max(wait, (1 - tokens) / rate)
+            end
+        end
+        for i, key in ipairs(KEYS) do
+            local rate = tonumber(ARGV[2 * i])
+            local capacity = tonumber(ARGV[2 * i + 1])
+            local tokens = levels[i]
+            if wait == 0 then
+                tokens = tokens - 1
+            end
+            redis.call('HSET', key, 'tokens', tokens, 'updated', now)
+            redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+        end
+        return tostring(wait)
+    '''
+
+    def __init__(self, client, prefix='trivia:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def consume(self, buckets):
+        keys = [self.prefix + key for key, rate, capacity in buckets]
+        limits = [value for key, rate, capacity in buckets
+                  for value in (rate, capacity)]
+        return float(self.client.eval(self.SCRIPT, len(keys), *keys,
+                                      time.time(), *limits))
+
+
+class RateLimiter:
+    '''
+    Checks every request against the token buckets configured for its
+    endpoint in RATE_LIMITS and answers 429 with a Retry-After header when
+    either the client's bucket or the route's bucket is empty. a rejected
+    request takes no token from either.
+    '''
+
+    def __init__(self, app, store=None):
+        self.limits = app.config['RATE_LIMITS']
+        self.store = store or MemoryBucketStore()
+        app.before_request(self.check)
+
+    def check(self):
+        limits = self.limits.get(request.endpoint)
+        if limits is None:
+            return None
+
+        buckets = []
+        if 'client' in limits:
+            buckets.append(('{}:{}'.format(request.endpoint, request.remote_addr),
+                            *limits['client']))
+        if 'route' in limits:
+            buckets.append((request.endpoint, *limits['route']))
+
+        wait = self.store.consume(buckets)
+        if wait:
+            response = jsonify({
+                'success': False,
+                'message': 'Too many requests'
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
+        return None
+
+
+def create_store(app):
+    '''
+    the bucket store named by the app config: RATE_LIMIT_STORE if set,
+    Redis when RATE_LIMIT_REDIS_URL is set, process memory otherwise.
+    '''
+    if app.config.get('RATE_LIMIT_STORE') is not None:
+        return app.config['RATE_LIMIT_STORE']
+    if app.config.get('RATE_LIMIT_REDIS_URL'):
+        import redis
+        return RedisBucketStore(redis.from_url(app.config['RATE_LIMIT_REDIS_URL']))
+    return MemoryBucketStore()
@@ -0,0 +1,289 @@
+'''
+Live multiplayer quiz rooms over WebSockets.
+
+Run next to the REST API with
+    python -m flaskr.rooms --port 8765
+
+Messages are JSON objects with a `type`:
+    client -> server
+        {"type": "join", "room": "friday", "name": "ana"}
+        {"type": "start", "category": 0, "rounds": 10, "seconds": 15,
+         "difficulty": [1, 2]}                   (room host only)
+        {"type": "answer", "id": 21, "answer": "Alexander Fleming"}
+    server -> client
+        {"type": "joined", "room": "friday", "host": true, "players": 1}
+        {"type": "question", "round": 1, "id": 21, "question": "...",
+         "category": 1, "difficulty": 3, "deadline": 1571234567.5}
+        {"type": "scores", "round": 1, "id": 21, "answer": "...",
+         "delta": {"ana": 870}}
+        {"type": "end", "scores": {"ana": 870}}
+        {"type": "error", "message": "..."}
+'''
+import argparse
+import asyncio
+import json
+import time
+
+try:
+    import websockets
+except ImportError:  # only the room server needs it, the REST API runs without
+    websockets = None
+
+from .quiz import draw_questions, MAX_QUESTIONS_PER_ROUND
+from .answers import AnswerForm
+
+DEFAULT_ROUNDS = 10
+DEFAULT_SECONDS = 15
+MAX_ROUNDS = MAX_QUESTIONS_PER_ROUND
+MAX_SECONDS = 120
+BASE_POINTS = 500
+SPEED_POINTS = 500
+
+
+def game_settings(settings):
+    '''
+    the category, rounds, seconds per round and difficulties of a start
+    message. raises ValueError unless 1 <= rounds <= MAX_ROUNDS and
+    0 < seconds <= MAX_SECONDS.
+    '''
+    try:
+        category = int(settings.get('category', 0))
+        rounds = int(settings.get('rounds', DEFAULT_ROUNDS))
+        seconds = float(settings.get('seconds', DEFAULT_SECONDS))
+        difficulties = settings.get('difficulty')
+        if difficulties is not None:
+            difficulties = [int(level) for level in difficulties]
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e))
+    if not 1 <= rounds <= MAX_ROUNDS or not 0 < seconds <= MAX_SECONDS:
+        raise ValueError('rounds or seconds out of range')
+    return category, rounds, seconds, difficulties
+
+
+class Player:
+    __slots__ = ('name', 'score')
+
+    def __init__(self, name):
+        self.name = name
+        self.score = 0
+
+
+class Room:
+    '''
+    players of one room and the state of the round being played.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.players = {}
+        self.host = None
+        self.game = None
+        self.question = None
+        self.answerForm = None
+        self.deadline = None
+        self.answers = {}
+        self.allAnswered = asyncio.Event()
+
+    def broadcast(self, message):
+        # serialized once, written to every socket without waiting on slow ones
+        websockets.broadcast(list(self.players), json.dumps(message))
+
+    def join(self, websocket, name):
+        if any(player.name == name for player in self.players.values()):
+            return None
+        self.players[websocket] = Player(name)
+        if self.host is None:
+            self.host = websocket
+        return self.players[websocket]
+
+    def leave(self, websocket):
+        self.players.pop(websocket, None)
+        self.answers.pop(websocket, None)
+        if self.host is websocket:
+            self.host = next(iter(self.players), None)
+
+    def open_round(self, question, seconds):
+        self.question = question
+        self.answerForm = AnswerForm(question['answer'])
+        self.deadline = time.time() + seconds
+        self.answers = {}
+        self.allAnswered.clear()
+
+    def answer(self, websocket, message):
+        '''
+        keeps the first answer of each player given before the deadline.
+        '''
+        if self.question is None or message.get('id') != self.question['id'] \
+                or websocket in self.answers or time.time() > self.deadline:
+            return
+        self.answers[websocket] = (message.get('answer'), time.time())
+        if len(self.answers) >= len(self.players):
+            self.allAnswered.set()
+
+    def close_round(self, seconds):
+        '''
+        scores the answers of the round, returns the points won per player.
+        '''
+        delta = {}
+        for websocket, (answer, answeredAt) in self.answers.items():
+            player = self.players.get(websocket)
+            if player is None or not isinstance(answer, str) or \
+                    not self.answerForm.matches(answer):
+                continue
+            remaining = max(0.0, self.deadline - answeredAt)
+            points = BASE_POINTS + int(SPEED_POINTS * remaining / seconds)
+            player.score += points
+            delta[player.name] = points
+        self.question = None
+        return delta
+
+    def scores(self):
+        return {player.name: player.score for player in sorted(
+            self.players.values(), key=lambda player: -player.score)}
+
+
+class RoomServer:
+    '''
+    asyncio WebSocket server hosting any number of rooms. questions come from
+    the same sampler as /quizzes/batch: a whole game is drawn with one query,
+    run in a worker thread inside the Flask app's context.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.rooms = {}
+
+    async def handle(self, websocket, path=None):
+        room = None
+        try:
+            async for raw in websocket:
+                try:
+                    message = json.loads(raw)
+                    kind = message['type']
+                except (ValueError, TypeError, KeyError):
+                    await self.error(websocket, 'malformed message')
+                    continue
+
+                if kind == 'join' and room is None:
+                    room = self.join(websocket, message)
+                    if room is None:
+                        await self.error(websocket, 'name already taken')
+                        continue
+                    await websocket.send(json.dumps({
+                        'type': 'joined',
+                        'room': room.name,
+                        'host': room.host is websocket,
+                        'players': len(room.players)
+                    }))
+                elif room is None:
+                    await self.error(websocket, 'join a room first')
+                elif kind == 'start':
+                    if room.host is not websocket:
+                        await self.error(websocket, 'only the host can start')
+                    elif room.game is not None and not room.game.done():
+                        await self.error(websocket, 'game already running')
+                    else:
+                        room.game = asyncio.ensure_future(self.play(room, message))
+                elif kind == 'answer':
+                    room.answer(websocket, message)
+                else:
+                    await self.error(websocket, 'unknown message type')
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if room is not None:
+                self.leave(room, websocket)
+
+    async def error(self, websocket, description):
+        await websocket.send(json.dumps({'type': 'error', 'message': description}))
+
+    def join(self, websocket, message):
+        name = str(message.get('name') or 'player')
+        roomName = str(message.get('room') or 'lobby')
+        room = self.rooms.get(roomName)
+        if room is None:
+            room = self.rooms[roomName] = Room(roomName)
+        if room.join(websocket, name) is None:
+            return None
+        return room
+
+    def leave(self, room, websocket):
+        room.leave(websocket)
+        if not room.players:
+            if room.game is not None:
+                room.game.cancel()
+            self.rooms.pop(room.name, None)
+
+    def draw(self, category, rounds, difficulties):
+        with self.app.app_context():
+            return [question.format() for question
+                    in draw_questions(category, (), rounds, difficulties)]
+
+    async def play(self, room, settings):
+        try:
+            category, rounds, seconds, difficulties = game_settings(settings)
+        except ValueError:
+            room.broadcast({'type': 'error', 'message': 'invalid game settings'})
+            return
+
+        try:
+            await self.run_game(room, category, rounds, seconds, difficulties)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # the task would die silently, tell the room the game is over
+            self.app.logger.exception('quiz room %s failed', room.name)
+            room.question = None
+            room.broadcast({'type': 'error', 'message': 'the game stopped'})
+
+    async def run_game(self, room, category, rounds, seconds, difficulties):
+        loop = asyncio.get_event_loop()
+        questions = await loop.run_in_executor(
+            None, self.draw, category, rounds, difficulties)
+
+        for number, question in enumerate(questions, 1):
+            room.open_round(question, seconds)
+            room.broadcast({
+                'type': 'question',
+                'round': number,
+                'id': question['id'],
+                'question': question['question'],
+                'category': question['category'],
+                'difficulty': question['difficulty'],
+                'deadline': room.deadline
+            })
+            try:
+                await asyncio.wait_for(room.allAnswered.wait(), seconds)
+            except asyncio.TimeoutError:
+                pass
+            room.broadcast({
+                'type': 'scores',
+                'round': number,
+                'id': question['id'],
+                'answer': question['answer'],
+                'delta': room.close_round(seconds)
+            })
+
+        room.broadcast({'type': 'end', 'scores': room.scores()})
+
+
+async def serve(app, host='localhost', port=8765):
+    '''
+    runs the room server until cancelled.
+    '''
+    if websockets is None:
+        raise RuntimeError('the quiz room server needs the websockets package')
+    server = RoomServer(app)
+    async with websockets.serve(server.handle, host, port, max_size=2 ** 16):
+        await asyncio.Future()
+
+
+if __name__ == '__main__':
+    from . import create_app
+
+    parser = argparse.ArgumentParser(description='Trivia quiz room server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    arguments = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(
+        serve(create_app(), arguments.host, arguments.port))
@@ -0,0 +1,138 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import literal_column
+from sqlalchemy.sql.expression import func
+
+from models import db, Question, question_document, on_questions_committed
+
+TOKEN_PATTERN = re.compile(r'\w+')
+QUESTION_WEIGHT = 1.0
+ANSWER_WEIGHT = 0.4
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+class QuestionIndex:
+    '''
+    In-memory inverted index over question and answer text, used when the
+    database has no full-text support (SQLite in tests).
+    Query terms match as prefixes and all of them must match, like the
+    `term:* & term:*` queries sent to Postgres.
+    '''
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.tokens = []
+
+    def add(self, question):
+        self.remove(question['id'])
+        weights = defaultdict(float)
+        for token in tokenize(question['question']):
+            weights[token] += QUESTION_WEIGHT
+        for token in tokenize(question['answer']):
+            weights[token] += ANSWER_WEIGHT
+
+        for token, weight in weights.items():
+            if token not in self.postings:
+                self.tokens.insert(bisect_left(self.tokens, token), token)
+            self.postings[token][question['id']] = weight
+        self.documents[question['id']] = list(weights)
+
+    def remove(self, questionId):
+        for token in self.documents.pop(questionId, []):
+            posting = self.postings[token]
+            posting.pop(questionId, None)
+            if not posting:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def prefix_matches(self, prefix):
+        scores = defaultdict(float)
+        position = bisect_left(self.tokens, prefix)
+        while position < len(self.tokens) and \
+                self.tokens[position].startswith(prefix):
+            for questionId, weight in self.postings[self.tokens[position]].items():
+                scores[questionId] += weight
+            position += 1
+        return scores
+
+    def search(self, term):
+        '''
+        returns the ids of the matching questions, best match first.
+        '''
+        scores = None
+        for prefix in sorted(set(tokenize(term)), key=len, reverse=True):
+            matches = self.prefix_matches(prefix)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {questionId: score + matches[questionId]
+                          for questionId, score in scores.items()
+                          if questionId in matches}
+            if not scores:
+                return []
+
+        return sorted(scores or {}, key=lambda questionId: (-scores[questionId],
+                                                            questionId))
+
+
+def get_question_index():
+    index = current_app.extensions.get('question_index')
+    if index is None:
+        index = QuestionIndex()
+        rows = db.session.query(Question.id, Question.question, Question.answer)
+        for row in rows:
+            index.add(row._asdict())
+        current_app.extensions['question_index'] = index
+    return index
+
+
+@on_questions_committed
+def sync_question_index(inserted, updated, deleted):
+    index = current_app.extensions.get('question_index')
+    if index is None:
+        return
+    for question in deleted:
+        index.remove(question['id'])
+    for question in inserted + updated:
+        index.add(question)
+
+
+def search_questions(term, page, perPage):
+    '''
+    Ranked full-text search over question and answer text.
+    returns one page of matching questions, best match first, and the total
+    number of matches. page starts at 1.
+    '''
+    if page < 1:
+        raise ValueError('page must be at least 1')
+    tokens = tokenize(term)
+    if not tokens:
+        return [], 0
+    start = (page - 1) * perPage
+
+    if db.engine.dialect.name == 'postgresql':
+        document = literal_column(question_document)
+        query = func.to_tsquery(
+            'english', ' & '.join(token + ':*' for token in tokens))
+        rows = db.session.query(Question, func.count().over())\
+            .filter(document.op('@@')(query))\
+            .order_by(func.ts_rank(document, query).desc(), Question.id)\
+            .offset(start).limit(perPage).all()
+        total = rows[0][1] if rows else 0
+        return [question for question, _ in rows], total
+
+    matches = get_question_index().search(term)
+    pageIds = matches[start:start + perPage]
+    if not pageIds:
+        return [], len(matches)
+    questions = {question.id: question for question
+                 in Question.query.filter(Question.id.in_(pageIds))}
+    return [questions[questionId] for questionId in pageIds
+            if questionId in questions], len(matches)
@@ -0,0 +1,63 @@
+import re
+
+from models import db
+
+COPY_PATTERN = re.compile(r'^COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;$')
+ESCAPE_PATTERN = re.compile(r'\\(.)')
+ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v'}
+
+
+def unescape(value):
+    if value == '\\N':
+        return None
+    return ESCAPE_PATTERN.sub(
+        lambda match: ESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def parse_psql_dump(lines):
+    '''
+    yields (table name, rows) for every COPY block of a plain-text pg_dump.
+    '''
+    table = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if table is None:
+            match = COPY_PATTERN.match(line)
+            if match:
+                table = match.group(1)
+                columns = [column.strip() for column in match.group(2).split(',')]
+                rows = []
+        elif line == '\\.':
+            yield table, rows
+            table = None
+        else:
+            rows.append(dict(zip(columns, map(unescape, line.split('\t')))))
+
+
+def load_psql_dump(path):
+    '''
+    Loads the data of a plain-text pg_dump (trivia.psql) into the tables of
+    the current app's database, one multi-row insert per table. used to seed
+    the in-memory SQLite database, the schema itself comes from the models.
+    '''
+    # parents first so foreign keys are satisfied
+    tables = {table.name: table for table in db.metadata.sorted_tables}
+    order = list(tables)
+    with open(path, encoding='utf-8') as dump:
+        blocks = [block for block in parse_psql_dump(dump) if block[0] in tables]
+
+    for name, rows in sorted(blocks, key=lambda block: order.index(block[0])):
+        table = tables[name]
+        for row in rows:
+            for column, value in row.items():
+                if value is not None:
+                    row[column] = table.c[column].type.python_type(value)
+        if rows:
+            db.session.execute(table.insert(), rows)
+
+    if db.engine.dialect.name == 'postgresql':
+        for name, _ in blocks:
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "coalesce(max(id), 1)) FROM {0}".format(name))
+    db.session.commit()
@@ -0,0 +1,52 @@
+import time
+
+from flask import current_app
+from sqlalchemy.sql.expression import func
+
+from models import db, Question, Category, on_questions_committed
+
+# writes of other workers, or loaded straight into the database, show up
+# after at most this many seconds
+QUESTION_COUNTS_TTL = 5
+
+
+def question_counts():
+    '''
+    Number of questions per category and difficulty, from one grouped query.
+    the result is cached on the app for QUESTION_COUNTS_TTL seconds, or until
+    the next question write committed by this process.
+    '''
+    cached = current_app.extensions.get('question_counts')
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    rows = db.session.query(Category.id, Category.type, Question.difficulty,
+                            func.count(Question.id))\
+        .outerjoin(Question, Question.category == Category.id)\
+        .group_by(Category.id, Category.type, Question.difficulty)\
+        .order_by(Category.id)
+
+    categories = {}
+    for categoryId, categoryType, difficulty, count in rows:
+        category = categories.setdefault(categoryId, {
+            'type': categoryType,
+            'total_questions': 0,
+            'difficulties': {}
+        })
+        if difficulty is not None:
+            category['difficulties'][difficulty] = count
+        category['total_questions'] += count
+
+    counts = {
+        'categories': categories,
+        'total_questions': sum(category['total_questions']
+                               for category in categories.values())
+    }
+    current_app.extensions['question_counts'] = (
+        time.monotonic() + QUESTION_COUNTS_TTL, counts)
+    return counts
+
+
+@on_questions_committed
+def invalidate_question_counts(inserted, updated, deleted):
+    current_app.extensions.pop('question_counts', None)
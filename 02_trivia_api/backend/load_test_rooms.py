@@ -0,0 +1,116 @@
+'''
+Load test for the quiz room server.
+
+Starts the room server in-process on an in-memory copy of trivia.psql (or
+connects to a running one with --url), then plays one game with thousands of
+simulated players spread over several rooms and reports how long question
+broadcasts take to reach every player.
+
+    python load_test_rooms.py --players 2000 --rooms 10 --rounds 5
+'''
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+import websockets
+
+from flaskr import create_memory_app
+from flaskr.rooms import serve
+
+
+async def player(url, room, name, settings, latencies, handshakes, ready, start):
+    # connections are opened a hundred at a time, like users trickling in
+    async with handshakes:
+        websocket = await websockets.connect(url, max_size=2 ** 16)
+    try:
+        await websocket.send(json.dumps({'type': 'join', 'room': room, 'name': name}))
+        joined = json.loads(await websocket.recv())
+        ready.release()
+        if joined['host']:
+            await start.wait()
+            await websocket.send(json.dumps(dict(settings, type='start')))
+
+        async for raw in websocket:
+            message = json.loads(raw)
+            if message['type'] == 'question':
+                sent = message['deadline'] - settings['seconds']
+                latencies['question'].append(time.time() - sent)
+                await asyncio.sleep(random.uniform(0, settings['seconds'] / 4))
+                await websocket.send(json.dumps({
+                    'type': 'answer',
+                    'id': message['id'],
+                    'answer': random.choice(['wrong', 'Alexander Fleming'])
+                }))
+            elif message['type'] == 'scores':
+                latencies['scores'] += 1
+            elif message['type'] == 'end':
+                return
+    finally:
+        await websocket.close()
+
+
+def report(name, samples):
+    if not samples:
+        print('{:>10}: no samples'.format(name))
+        return
+    samples = sorted(samples)
+    print('{:>10}: {} messages, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+        name, len(samples),
+        statistics.median(samples) * 1000,
+        samples[int(len(samples) * 0.99) - 1] * 1000,
+        samples[-1] * 1000))
+
+
+async def main(arguments):
+    server = None
+    url = arguments.url
+    if url is None:
+        app = create_memory_app()
+        server = asyncio.ensure_future(serve(app, 'localhost', arguments.port))
+        await asyncio.sleep(0.5)
+        url = 'ws://localhost:{}'.format(arguments.port)
+
+    settings = {'rounds': arguments.rounds, 'seconds': arguments.seconds,
+                'category': 0}
+    latencies = {'question': [], 'scores': 0}
+    handshakes = asyncio.Semaphore(100)
+    ready = asyncio.Semaphore(0)
+    start = asyncio.Event()
+    clients = []
+    connectStarted = time.time()
+    for number in range(arguments.players):
+        room = 'room-{}'.format(number % arguments.rooms)
+        clients.append(asyncio.ensure_future(player(
+            url, room, 'player-{}'.format(number), settings, latencies,
+            handshakes, ready, start)))
+    for _ in range(arguments.players):
+        await ready.acquire()
+    print('{} players joined {} rooms in {:.2f} s'.format(
+        arguments.players, arguments.rooms, time.time() - connectStarted))
+
+    gameStarted = time.time()
+    start.set()
+    await asyncio.gather(*clients)
+    print('{} rounds played in {:.2f} s'.format(
+        arguments.rounds, time.time() - gameStarted))
+
+    report('question', latencies['question'])
+    print('{:>10}: {} messages'.format('scores', latencies['scores']))
+
+    if server is not None:
+        server.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quiz room load test')
+    parser.add_argument('--url', default=None,
+                        help='room server to test, default starts one in-process')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seconds', type=float, default=2)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
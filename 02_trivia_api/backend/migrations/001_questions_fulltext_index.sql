@@ -0,0 +1,10 @@
+--
+-- Full-text search over question and answer text.
+-- The expression must stay identical to `question_document` in models.py,
+-- otherwise Postgres cannot use the index for the search queries.
+--
+-- psql trivia < migrations/001_questions_fulltext_index.sql
+--
+
+CREATE INDEX IF NOT EXISTS ix_questions_fulltext ON public.questions
+    USING GIN ((setweight(to_tsvector('english', coalesce(question, '')), 'A') || setweight(to_tsvector('english', coalesce(answer, '')), 'B')));
@@ -0,0 +1,26 @@
+--
+-- questions.category becomes an integer foreign key to categories.id and
+-- gets a (category, difficulty) index, so per-category listings and quiz
+-- draws are index lookups instead of casts over the whole table.
+--
+-- psql trivia < migrations/002_questions_category_foreign_key.sql
+--
+
+BEGIN;
+
+-- backfill: numeric strings become their integer id, anything else NULL
+ALTER TABLE public.questions
+    ALTER COLUMN category TYPE integer
+    USING CASE WHEN category::text ~ '^[0-9]+$' THEN category::text::integer END;
+
+UPDATE public.questions SET category = NULL
+    WHERE category IS NOT NULL
+    AND category NOT IN (SELECT id FROM public.categories);
+
+ALTER TABLE public.questions DROP CONSTRAINT IF EXISTS category;
+ALTER TABLE public.questions
+    ADD CONSTRAINT category FOREIGN KEY (category) REFERENCES public.categories(id) ON UPDATE CASCADE ON DELETE SET NULL;
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty ON public.questions (category, difficulty);
+
+COMMIT;
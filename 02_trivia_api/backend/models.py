@@ -1,6 +1,7 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, ForeignKey, Index, create_engine, event, DDL
 from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
 import json
 
 database_name = "trivia"
@@ -11,13 +12,19 @@ db = SQLAlchemy()
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the database is taken from path, else from the app config
+    (SQLALCHEMY_DATABASE_URI), else the local trivia database. the app is not
+    made the default app of `db`, so several apps with their own databases
+    can live in one process; use them inside an app context.
 '''
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, path=None):
+    if path is not None:
+        app.config["SQLALCHEMY_DATABASE_URI"] = path
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", database_path)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
     db.init_app(app)
-    db.create_all()
+    with app.app_context():
+        db.create_all()
 
 '''
 Question
@@ -29,9 +36,15 @@ class Question(db.Model):
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey(
+      'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
+  # per-category listings and quiz draws filter on category, then difficulty
+  __table_args__ = (
+      Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+  )
+
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
@@ -58,6 +71,52 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+'''
+question_document
+    the weighted tsvector of a question (question text ranks above answer
+    text). full-text queries must use this exact expression so Postgres can
+    answer them from the GIN index below.
+'''
+question_document = (
+    "(setweight(to_tsvector('english', coalesce(question, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(answer, '')), 'B'))")
+
+event.listen(
+    Question.__table__, 'after_create',
+    DDL('CREATE INDEX IF NOT EXISTS ix_questions_fulltext ON questions '
+        'USING GIN ({})'.format(question_document))
+    .execute_if(dialect='postgresql'))
+
+'''
+on_questions_committed(listener)
+    registers listener(inserted, updated, deleted), called after every commit
+    that wrote questions with lists of the formatted questions of each kind.
+    lets in-memory indexes follow the questions table without re-reading it.
+'''
+question_listeners = []
+
+def on_questions_committed(listener):
+    question_listeners.append(listener)
+    return listener
+
+@event.listens_for(db.session, 'after_flush')
+def collect_question_changes(session, flush_context):
+    changes = session.info.setdefault('question_changes', ([], [], []))
+    for kind, objects in enumerate((session.new, session.dirty, session.deleted)):
+        changes[kind].extend(
+            obj.format() for obj in objects if isinstance(obj, Question))
+
+@event.listens_for(db.session, 'after_commit')
+def publish_question_changes(session):
+    changes = session.info.pop('question_changes', None)
+    if changes and any(changes):
+        for listener in question_listeners:
+            listener(*changes)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_question_changes(session):
+    session.info.pop('question_changes', None)
+
 '''
 Category
 
@@ -75,4 +134,28 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+QuizAttempt
+    one answer given during a quiz, used to recalibrate question difficulty.
+    rows are written in batches by flaskr.analytics.AttemptRecorder.
+'''
+class QuizAttempt(db.Model):
+  __tablename__ = 'quiz_attempts'
+
+  id = Column(Integer, primary_key=True)
+  question_id = Column(Integer, ForeignKey('questions.id', ondelete='CASCADE'),
+                       nullable=False, index=True)
+  correct = Column(Boolean, nullable=False)
+  latency_ms = Column(Integer)
+  created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+  def format(self):
+    return {
+      'id': self.id,
+      'question_id': self.question_id,
+      'correct': self.correct,
+      'latency_ms': self.latency_ms,
+      'created_at': self.created_at.isoformat()
+    }
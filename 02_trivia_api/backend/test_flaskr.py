@@ -1,34 +1,45 @@
+import asyncio
 import os
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from unittest import mock
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import create_app, create_memory_app
+from flaskr.analytics import STATS_TTL
+from flaskr.dedupe import DuplicateIndex, MAX_BUCKET_PAIRS
+from flaskr.ratelimit import MemoryBucketStore
+from flaskr.stats import QUESTION_COUNTS_TTL
+from flaskr.rooms import Room, RoomServer, game_settings, BASE_POINTS
+from models import db, Question, Category, QuizAttempt
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables and initialize app.
+
+        Every test gets its own in-memory SQLite database seeded from
+        trivia.psql. Set TRIVIA_TEST_DATABASE_URL to run against a restored
+        Postgres database instead.
+        """
+        self.database_path = os.environ.get('TRIVIA_TEST_DATABASE_URL')
+        if self.database_path is None:
+            self.app = create_memory_app()
+        else:
+            self.app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://postgres:postgres@{}/{}".format(
-            'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
 
         # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        self.context = self.app.app_context()
+        self.context.push()
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        self.app.extensions['attempt_recorder'].stop()
+        self.context.pop()
 
     """
     Write at least one test for each test for successful operation and for expected errors.
@@ -43,6 +54,48 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertTrue(len(data['categories']))
 
+    def testGetStats(self):
+        res = self.client().get('/stats')
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['categories']), 6)
+        self.assertEqual(data['categories']['1']['type'], 'Science')
+        self.assertEqual(data['total_questions'], len(Question.query.all()))
+        self.assertEqual(data['categories']['1']['total_questions'],
+                         sum(data['categories']['1']['difficulties'].values()))
+
+    def testStatsFollowQuestionWrites(self):
+        before = json.loads(self.client().get('/stats').data.decode('utf-8'))
+        self.client().post(
+            '/questions',
+            json={
+                'question': 'test question',
+                'answer': 'answer',
+                'difficulty': 5,
+                'category': 2})
+        after = json.loads(self.client().get('/stats').data.decode('utf-8'))
+
+        self.assertEqual(after['total_questions'], before['total_questions'] + 1)
+        self.assertEqual(after['categories']['2']['difficulties'].get('5', 0),
+                         before['categories']['2']['difficulties'].get('5', 0) + 1)
+
+    def testStatsExpireAfterDirectLoads(self):
+        before = json.loads(self.client().get('/stats').data.decode('utf-8'))
+        # a load that bypasses the session, as another worker or a seed would
+        db.session.execute(Question.__table__.insert().values(
+            question='loaded question', answer='answer', difficulty=1, category=3))
+        db.session.commit()
+        cached = json.loads(self.client().get('/stats').data.decode('utf-8'))
+
+        later = time.monotonic() + QUESTION_COUNTS_TTL
+        with mock.patch('flaskr.stats.time.monotonic', return_value=later):
+            after = json.loads(self.client().get('/stats').data.decode('utf-8'))
+
+        self.assertEqual(cached['total_questions'], before['total_questions'])
+        self.assertEqual(after['total_questions'], before['total_questions'] + 1)
+
     def testGetPaginatedQuestions(self):
         res = self.client().get('/questions')
         data = json.loads(res.data.decode('utf-8'))
@@ -127,6 +180,134 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'],
                          totalQuestionsBeforeCreatingNewQuestion + 1)
 
+    def testCreateQuestionStoresIntegerCategory(self):
+        res = self.client().post(
+            '/questions',
+            json={
+                'question': 'test question',
+                'answer': 'answer',
+                'difficulty': '2',
+                'category': '3'})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            question = Question.query.get(data['created'])
+            self.assertEqual(question.category, 3)
+            self.assertEqual(question.difficulty, 2)
+
+    def test409SentCreatingDuplicateQuestion(self):
+        res = self.client().post(
+            '/questions',
+            json={
+                'question': 'Who discovered the penicillin?',
+                'answer': 'Alexander Fleming',
+                'difficulty': 3,
+                'category': 1,
+                'check_duplicates': True})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['duplicates'][0]['id'], 21)
+
+    def testGetDuplicateQuestions(self):
+        self.client().post(
+            '/questions',
+            json={
+                'question': 'Who discovered penicilin?',
+                'answer': 'Alexander Flemming',
+                'difficulty': 3,
+                'category': 1})
+        res = self.client().get('/questions/duplicates')
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(any(21 in [question['id'] for question in cluster['questions']]
+                            for cluster in data['clusters']))
+
+    def testDuplicateClustersOfHotBucket(self):
+        index = DuplicateIndex()
+        for questionId in range(MAX_BUCKET_PAIRS * 4):
+            index.add({'id': questionId, 'answer': 'a city',
+                       'question': 'What is the capital of country {}?'.format(questionId)})
+        clusters = index.clusters()
+
+        self.assertEqual([ids for ids, _ in clusters], [list(range(MAX_BUCKET_PAIRS * 4))])
+        # kept until the index changes
+        self.assertIs(index.clusters(), clusters)
+        index.remove(0)
+        self.assertEqual(len(index.clusters()[0][0]), MAX_BUCKET_PAIRS * 4 - 1)
+
+    def testCreateQuestionsInBulk(self):
+        totalQuestionsBeforeCreatingNewQuestions = len(Question.query.all())
+
+        res = self.client().post(
+            '/questions/bulk',
+            json=[
+                {'question': 'first bulk question', 'answer': 'answer',
+                 'difficulty': 1, 'category': 1},
+                {'question': '', 'answer': 'answer',
+                 'difficulty': 1, 'category': 1},
+                {'question': 'second bulk question', 'answer': 'answer',
+                 'difficulty': 2, 'category': 1000}])
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([result['success'] for result in data['results']],
+                         [True, False, False])
+        self.assertEqual(len(Question.query.all()),
+                         totalQuestionsBeforeCreatingNewQuestions + 1)
+
+    def testCreateQuestionsInBulkFromNdjson(self):
+        rows = [json.dumps({'question': 'ndjson question {}'.format(i),
+                            'answer': 'answer', 'difficulty': 3,
+                            'category': 2}) for i in range(3)]
+        res = self.client().post('/questions/bulk',
+                                 data='\n'.join(rows + ['not json']),
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 3)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['results'][3]['index'], 3)
+
+    def test400SentCreatingQuestionsInBulkWithoutArray(self):
+        res = self.client().post('/questions/bulk', json={'question': 'q'})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def testExportQuestionsAsNdjson(self):
+        res = self.client().get('/questions/export?category=1')
+        rows = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(rows)
+        self.assertEqual({row['category'] for row in rows}, {1})
+        self.assertEqual([row['id'] for row in rows],
+                         sorted(row['id'] for row in rows))
+
+    def testExportQuestionsAsCsv(self):
+        res = self.client().get('/questions/export?format=csv')
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertEqual(len(lines) - 1, len(Question.query.all()))
+
+    def test400SentExportingUnknownFormat(self):
+        res = self.client().get('/questions/export?format=xml')
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def testSearchQuestion(self):
         searchTerm = {'searchTerm': 'title'}
         res = self.client().post('/questions/search', json=searchTerm)
@@ -135,6 +316,48 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def testSearchQuestionMatchesAnswers(self):
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'victor'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['id'], 13)
+
+    def testSearchQuestionMatchesAllTerms(self):
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'soccer first'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['id'], 11)
+
+    def test404SentSearchingWithoutMatches(self):
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'xyzzy'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test422SentSearchingWithNonTextTerm(self):
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': ['title']})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test422SentSearchingBeforeFirstPage(self):
+        res = self.client().post('/questions/search?page=0',
+                                 json={'searchTerm': 'title'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_get_quizzes(self):
         res = self.client().post(
             '/quizzes',
@@ -149,6 +372,252 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question'])
         self.assertEqual(data['question']['category'], 1)
 
+    def testGetQuizzesBatch(self):
+        res = self.client().post(
+            '/quizzes/batch',
+            json={
+                'previous_questions': [20],
+                'quiz_category': {'id': 1, 'type': 'Science'},
+                'count': 5})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        questionIds = [question['id'] for question in data['questions']]
+        self.assertEqual(len(questionIds), len(set(questionIds)))
+        self.assertNotIn(20, questionIds)
+        for question in data['questions']:
+            self.assertEqual(question['category'], 1)
+
+    def testGetQuizzesBatchStratifiedByDifficulty(self):
+        res = self.client().post(
+            '/quizzes/batch',
+            json={
+                'quiz_category': {'id': 0},
+                'count': 4,
+                'difficulty': [1, 2]})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        difficulties = [question['difficulty'] for question in data['questions']]
+        self.assertEqual(len(difficulties), 4)
+        self.assertEqual(difficulties.count(1), 2)
+        self.assertEqual(difficulties.count(2), 2)
+
+    def test422SentRequestingTooManyQuizQuestions(self):
+        res = self.client().post(
+            '/quizzes/batch',
+            json={'quiz_category': {'id': 0}, 'count': 1000})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def testCheckQuizAnswerToleratesTypos(self):
+        res = self.client().post(
+            '/quizzes/answer',
+            json={'question_id': 20, 'answer': 'the livr'})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['correct'], True)
+        self.assertEqual(data['answer'], 'The Liver')
+
+    def test404SentCheckingAnswerOfUnknownQuestion(self):
+        res = self.client().post(
+            '/quizzes/answer',
+            json={'question_id': 1000, 'answer': 'Liver'})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def testCheckQuizAnswersBatch(self):
+        res = self.client().post('/quizzes/answers', json={'answers': [
+            {'question_id': 20, 'answer': 'LIVER'},
+            {'question_id': 20, 'answer': 'Heart'},
+            {'question_id': 1000, 'answer': 'Liver'},
+            {'question_id': 21, 'answer': 'Fleming Alexander'}]})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result.get('correct') for result in data['results']],
+                         [True, False, None, True])
+        self.assertEqual(data['results'][2]['error'], 'question not found')
+
+    def test422SentCheckingNonTextAnswer(self):
+        res = self.client().post(
+            '/quizzes/answers',
+            json={'answers': [{'question_id': 20, 'answer': 42}]})
+
+        self.assertEqual(res.status_code, 422)
+
+    def testCheckedAnswerFollowsQuestionEdits(self):
+        self.client().post('/quizzes/answer',
+                           json={'question_id': 20, 'answer': 'Liver'})
+        question = Question.query.get(20)
+        question.answer = 'Skin'
+        question.update()
+        res = self.client().post('/quizzes/answer',
+                                 json={'question_id': 20, 'answer': 'skin'})
+
+        self.assertEqual(json.loads(res.data)['correct'], True)
+
+    def testRecordQuizAttempts(self):
+        res = self.client().post(
+            '/quizzes/attempts',
+            json={'attempts': [
+                {'question_id': 21, 'correct': True, 'latency_ms': 1000},
+                {'question_id': 22, 'correct': False, 'latency_ms': 3000}]})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['accepted'], 2)
+
+        self.app.extensions['attempt_recorder'].flush()
+        res = self.client().get('/quizzes/stats?category=1')
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions']['21']['correct'], 1)
+        self.assertEqual(data['categories']['1']['attempts'], 2)
+        self.assertEqual(data['categories']['1']['accuracy'], 0.5)
+        self.assertEqual(data['categories']['1']['average_latency_ms'], 2000)
+
+    def testQuizStatsFollowAttemptsOfOtherWorkers(self):
+        recorder = self.app.extensions['attempt_recorder']
+        self.assertEqual(recorder.stats(1)['questions'], {})
+        # written by another worker: this recorder never saw them
+        db.session.bulk_insert_mappings(QuizAttempt, [
+            {'question_id': 21, 'correct': True, 'created_at': datetime.utcnow()}])
+        db.session.commit()
+
+        self.assertEqual(recorder.stats(1)['questions'], {})
+        later = time.monotonic() + STATS_TTL
+        with mock.patch('flaskr.analytics.time.monotonic', return_value=later):
+            self.assertEqual(recorder.stats(1)['questions'][21]['attempts'], 1)
+
+    def testRecordQuizAttemptsDropsBeyondBufferLimit(self):
+        attempts = [{'question_id': 21, 'correct': True}] * 3
+        with mock.patch('flaskr.analytics.MAX_BUFFERED_ATTEMPTS', 2), \
+                self.assertLogs(self.app.logger, 'WARNING') as logs:
+            res = self.client().post('/quizzes/attempts',
+                                     json={'attempts': attempts})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(data['accepted'], 2)
+        self.assertIn('dropped 1 attempts', logs.output[0])
+
+    def testStoppedRecorderFlushesAndEndsThread(self):
+        recorder = self.app.extensions['attempt_recorder']
+        self.client().post('/quizzes/attempts',
+                           json={'question_id': 21, 'correct': True})
+        recorder.stop()
+
+        self.assertFalse(recorder.worker.is_alive())
+        self.assertEqual(len(recorder.buffer), 0)
+        self.assertEqual(recorder.stats(1)['questions'][21]['attempts'], 1)
+
+    def test422SentRecordingMalformedQuizAttempt(self):
+        res = self.client().post(
+            '/quizzes/attempts',
+            json={'question_id': 21, 'correct': 'yes'})
+        data = json.loads(res.data.decode('utf-8'))
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def testConfiguredPageSize(self):
+        self.context.pop()
+        app = create_memory_app({'QUESTIONS_PER_PAGE': 5})
+        res = app.test_client().get('/questions')
+        data = json.loads(res.data.decode('utf-8'))
+        self.context.push()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), 5)
+
+    def testAppsHaveIsolatedDatabases(self):
+        self.client().delete('/questions/5')
+        self.context.pop()
+        other = create_memory_app()
+        with other.app_context():
+            self.assertIsNotNone(Question.query.get(5))
+        self.context.push()
+
+        self.assertIsNone(Question.query.get(5))
+
+    def test429SentExceedingQuizRateLimit(self):
+        self.context.pop()
+        app = create_memory_app({'RATE_LIMITS': {'get_quizzes': {'client': (0.1, 2)}}})
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 0}}
+        responses = [app.test_client().post('/quizzes', json=quiz)
+                     for _ in range(3)]
+        self.context.push()
+
+        self.assertEqual([res.status_code for res in responses], [200, 200, 429])
+        self.assertEqual(responses[2].headers['Retry-After'], '10')
+        self.assertEqual(json.loads(responses[2].data)['success'], False)
+
+    def testRejectedRequestKeepsClientTokens(self):
+        self.context.pop()
+        store = MemoryBucketStore()
+        app = create_memory_app({
+            'RATE_LIMITS': {'get_quizzes': {'client': (0.1, 2), 'route': (0.1, 1)}},
+            'RATE_LIMIT_STORE': store})
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 0}}
+        responses = [app.test_client().post('/quizzes', json=quiz)
+                     for _ in range(2)]
+        # refill the route: the client still has the token of the rejected call
+        tokens, updated = store.buckets['get_quizzes']
+        store.buckets['get_quizzes'] = (tokens + 1, updated)
+        responses.append(app.test_client().post('/quizzes', json=quiz))
+        self.context.push()
+
+        self.assertEqual([res.status_code for res in responses], [200, 429, 200])
+
+    def testQuizRoomScoresFirstCorrectAnswers(self):
+        room = Room('friday')
+        ana, bob = object(), object()
+        room.join(ana, 'ana')
+        room.join(bob, 'bob')
+        self.assertIsNone(room.join(object(), 'ana'))
+        self.assertIs(room.host, ana)
+
+        room.open_round(Question.query.get(20).format(), 15)
+        room.answer(ana, {'id': 20, 'answer': ' the liver '})
+        room.answer(ana, {'id': 20, 'answer': 'Wrong'})
+        room.answer(bob, {'id': 20, 'answer': 'Heart'})
+        delta = room.close_round(15)
+
+        self.assertEqual(list(delta), ['ana'])
+        self.assertGreater(delta['ana'], BASE_POINTS)
+        self.assertEqual(room.scores(), {'ana': delta['ana'], 'bob': 0})
+
+    def testQuizRoomRejectsOutOfRangeSettings(self):
+        self.assertEqual(game_settings({'rounds': 3, 'seconds': 5}), (0, 3, 5.0, None))
+        for settings in ({'seconds': 0}, {'seconds': -1}, {'rounds': 0},
+                         {'rounds': -1}, {'rounds': 10 ** 6}, {'seconds': 'soon'}):
+            with self.assertRaises(ValueError):
+                game_settings(settings)
+
+    def testQuizRoomReportsFailedGame(self):
+        class FailingRoomServer(RoomServer):
+            def draw(self, category, rounds, difficulties):
+                raise RuntimeError('database gone')
+
+        room = Room('friday')
+        messages = []
+        room.broadcast = messages.append
+        server = FailingRoomServer(self.app)
+        with self.assertLogs(self.app.logger, 'ERROR'):
+            asyncio.run(server.play(room, {'rounds': 0}))
+            asyncio.run(server.play(room, {'rounds': 2}))
+
+        self.assertEqual([message['message'] for message in messages],
+                         ['invalid game settings', 'the game stopped'])
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
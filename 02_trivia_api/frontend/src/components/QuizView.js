@@ -13,6 +13,7 @@ class QuizView extends Component {
         previousQuestions: [], 
         showAnswer: false,
         categories: {},
+        categoryCounts: {},
         numCorrect: 0,
         currentQuestion: {},
         guess: '',
@@ -22,11 +23,16 @@ class QuizView extends Component {
 
   componentDidMount(){
     $.ajax({
-      url: `/categories`, //TODO: update request URL
+      url: `/stats`,
       type: "GET",
       success: (result) => {
-          console.log(result)
-        this.setState({ categories: result.categories })
+        const categories = {}
+        const categoryCounts = {}
+        Object.keys(result.categories).forEach(id => {
+          categories[id] = result.categories[id].type
+          categoryCounts[id] = result.categories[id].total_questions
+        })
+        this.setState({ categories, categoryCounts })
         return;
       },
       error: (error) => {
@@ -116,7 +122,7 @@ class QuizView extends Component {
                       value={id}
                       className="play-category"
                       onClick={() => this.selectCategory({type:this.state.categories[id], id})}>
-                      {this.state.categories[id]}
+                      {this.state.categories[id]} ({this.state.categoryCounts[id]})
                     </div>
                   )
                 })}
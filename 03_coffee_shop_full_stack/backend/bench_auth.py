@@ -0,0 +1,77 @@
+'''
+Benchmark of the auth path of a protected endpoint.
+
+Mints tokens with the local issuer (src/auth/local_issuer.py), serves its
+public key as a JWKS file and measures the per-request cost of `requires_auth`:
+
+- full verification: RS256 signature and claims checked on every request
+- cached: the verified-token cache, as used by the API
+- requires_auth: the cached path through the decorator, including the
+  cost of a Flask test request context
+
+    python bench_auth.py --requests 2000 --tokens 20
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from flask import Flask
+
+from src.auth.local_issuer import LocalIssuer
+
+
+def measure(name, count, function):
+    started = time.perf_counter()
+    for _ in range(count):
+        function()
+    elapsed = time.perf_counter() - started
+    print('{:>20}: {:8.1f} us per request'.format(name, elapsed / count * 1e6))
+
+
+def main(arguments):
+    issuer = LocalIssuer(kid='bench')
+    jwksPath = os.path.join(tempfile.mkdtemp(), 'jwks.json')
+    os.environ.update(issuer.environment(issuer.write_jwks(jwksPath)))
+
+    # the settings are read at import
+    from src.auth import auth
+
+    tokens = [issuer.mint(['get:drinks-detail'],
+                          subject='auth0|barista{}'.format(number))
+              for number in range(arguments.tokens)]
+
+    def full():
+        payload = auth.verify_decode_jwt(random.choice(tokens))
+        auth.check_permissions('get:drinks-detail', payload)
+
+    def cached():
+        verified = auth.verify_token(random.choice(tokens))
+        auth.check_permissions('get:drinks-detail', verified.payload,
+                               verified.permissions)
+
+    app = Flask(__name__)
+
+    @auth.requires_auth('get:drinks-detail')
+    def view(payload):
+        return payload
+
+    def endpoint():
+        token = random.choice(tokens)
+        with app.test_request_context(
+                headers={'Authorization': 'Bearer ' + token}):
+            view()
+
+    full()  # fetch the signing keys once
+    measure('full verification', arguments.requests, full)
+    measure('cached', arguments.requests, cached)
+    measure('requires_auth', arguments.requests, endpoint)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Auth path benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--tokens', type=int, default=20,
+                        help='distinct tokens, i.e. signed in staff members')
+    main(parser.parse_args())
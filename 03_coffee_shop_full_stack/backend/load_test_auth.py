@@ -0,0 +1,183 @@
+'''
+Load test for the protected endpoints of the API.
+
+Every `requires_auth` route is called with tokens from the local issuer
+(src/auth/local_issuer.py), so no Auth0 tenant is needed. By default the API
+is started in-process on a throwaway database and trusts a freshly generated
+key. Each simulated staff member repeatedly creates a drink, edits it, reads
+the menu and the inventory, restocks, orders it, bulk updates two drinks and
+deletes it. Latencies are reported per permission.
+
+    python load_test_auth.py --workers 16 --iterations 50
+
+To load a running server, start the issuer first and the API with the
+settings it prints, then pass the same key file and issuer:
+
+    python -m src.auth.local_issuer --port 8089 --key issuer.pem
+    python load_test_auth.py --url http://127.0.0.1:5000 --key issuer.pem \\
+        --issuer http://127.0.0.1:8089/
+
+--fresh signs a new token for every request, measuring the uncached path
+(RS256 signature check) instead of the verified-token cache.
+'''
+import argparse
+import json
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from src.auth.local_issuer import LocalIssuer, PERMISSIONS
+
+
+def start_api(issuer):
+    '''
+    the API on a free local port, on a database in a temporary directory.
+    '''
+    directory = tempfile.mkdtemp()
+    os.environ.update(issuer.environment(
+        issuer.write_jwks(os.path.join(directory, 'jwks.json'))))
+
+    # the auth settings and the database path are read at import
+    from src.database import models
+    models.database_path = 'sqlite:///{}'.format(os.path.join(directory, 'load.db'))
+    from src.api import app
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+class Client:
+    def __init__(self, url, tokens, latencies):
+        self.url = url
+        self.tokens = tokens
+        self.latencies = latencies
+
+    def call(self, permission, method, path, body=None, route=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        request = Request(self.url + path, data=data, method=method, headers={
+            'Authorization': 'Bearer ' + next(self.tokens),
+            'Content-Type': 'application/json'
+        })
+        started = time.perf_counter()
+        try:
+            with urlopen(request) as response:
+                status, raw = response.status, response.read()
+        except HTTPError as e:
+            status, raw = e.code, e.read()
+        elapsed = time.perf_counter() - started
+        route = route or path.split('?')[0]
+        self.latencies.append((permission, method + ' ' + route, status, elapsed))
+        return status, json.loads(raw) if raw else None
+
+
+def staff_member(url, tokens, iterations, latencies):
+    client = Client(url, tokens, latencies)
+    name = uuid.uuid4().hex[:8]
+    recipe = [{'name': 'espresso-' + name, 'color': 'brown', 'parts': 1}]
+    for number in range(iterations):
+        title = 'load {} {}'.format(name, number)
+        status, body = client.call('post:drinks', 'POST', '/drinks',
+                                   {'title': title, 'recipe': recipe})
+        if status != 200:
+            continue
+        drinkId = body['drinks'][0]['id']
+        client.call('patch:drinks', 'PATCH', '/drinks/{}'.format(drinkId),
+                    {'title': title + ' v2'}, route='/drinks/<id>')
+        client.call('get:drinks-detail', 'GET', '/drinks-detail?limit=20')
+        client.call('get:drinks-detail', 'GET', '/inventory')
+        client.call('patch:inventory', 'PATCH', '/inventory',
+                    {'ingredients': {'espresso-' + name: 1000}})
+        client.call('post:orders', 'POST', '/orders', {'drink_id': drinkId})
+        client.call('put:drinks-bulk', 'PUT', '/drinks/bulk', [
+            {'title': 'load {} bulk {}'.format(name, part), 'recipe': recipe}
+            for part in range(2)])
+        client.call('delete:drinks', 'DELETE', '/drinks/{}'.format(drinkId),
+                    route='/drinks/<id>')
+
+
+def token_source(issuer, arguments):
+    '''
+    an endless iterator of tokens with every permission: a new one per
+    request with --fresh, else one of the staff members' tokens.
+    '''
+    if arguments.fresh:
+        count = arguments.workers * arguments.iterations * 8
+    else:
+        count = arguments.tokens
+    tokens = [issuer.mint(PERMISSIONS, subject='local|staff{}'.format(number))
+              for number in range(count)]
+    lock = threading.Lock()
+
+    def cycle():
+        position = 0
+        while True:
+            with lock:
+                token = tokens[position % len(tokens)]
+                position += 1
+            yield token
+    return cycle()
+
+
+def report(latencies, elapsed):
+    rows = {}
+    for permission, route, status, seconds in latencies:
+        row = rows.setdefault((permission, route), {'samples': [], 'statuses': {}})
+        row['samples'].append(seconds * 1000)
+        row['statuses'][status] = row['statuses'].get(status, 0) + 1
+
+    print('{:<18} {:<18} {:>6} {:>8} {:>8} {:>8} {:>8}  statuses'.format(
+        'permission', 'route', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for (permission, route), row in sorted(rows.items()):
+        samples = sorted(row['samples'])
+        percentile = lambda share: samples[min(len(samples) - 1, int(len(samples) * share))]
+        print('{:<18} {:<18} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}  {}'.format(
+            permission, route, len(samples), statistics.median(samples),
+            percentile(0.95), percentile(0.99), samples[-1],
+            ' '.join('{}x{}'.format(status, count)
+                     for status, count in sorted(row['statuses'].items()))))
+    print('{} requests in {:.1f} s, {:.0f} requests/s'.format(
+        len(latencies), elapsed, len(latencies) / elapsed))
+
+
+def main(arguments):
+    issuer = LocalIssuer(arguments.issuer, arguments.audience,
+                         key_path=arguments.key)
+    url = arguments.url or start_api(issuer)
+    tokens = token_source(issuer, arguments)
+
+    latencies = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(arguments.workers) as pool:
+        for future in [pool.submit(staff_member, url, tokens, arguments.iterations,
+                                   latencies)
+                       for _ in range(arguments.workers)]:
+            future.result()
+    report(latencies, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Auth path load test')
+    parser.add_argument('--url', default=None,
+                        help='a running API, by default one is started in-process')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='simulated staff members calling at once')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--tokens', type=int, default=16,
+                        help='distinct tokens shared by the workers')
+    parser.add_argument('--fresh', action='store_true',
+                        help='a new token for every request')
+    parser.add_argument('--key', default=None,
+                        help='PEM file of the issuer key, shared with --url')
+    parser.add_argument('--issuer', default='http://127.0.0.1:8089/')
+    parser.add_argument('--audience', default='coffeshop')
+    main(parser.parse_args())
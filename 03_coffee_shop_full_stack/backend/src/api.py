@@ -1,43 +1,145 @@
 import os
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort
 from sqlalchemy import exc
 import json
+import click
 from flask_cors import CORS
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
+from .database.models import db_drop_and_create_all, db_create_or_upgrade, setup_db, \
+    upsert_drinks, db, Drink
 from .auth.auth import AuthError, requires_auth
+from .menu import MenuCache, menu_page, FIELDS, MAX_PAGE_SIZE
+from .ingredients import ingredient_index
+from .orders import OrderPipeline, OutOfStock
+from .stream import MenuBroadcaster
+from .idempotency import IdempotencyStore, IdempotencyConflict, IdempotencyMismatch
+
+MAX_BULK_DRINKS = 1000
 
 app = Flask(__name__)
 setup_db(app)
 CORS(app)
 
-db_drop_and_create_all()
+# keeps the data: creates the schema on first start, migrates it when
+# needed. `flask reset-db` wipes the database on purpose
+db_create_or_upgrade()
+
+menu = MenuCache()
+menu.preload()
+
+orders = OrderPipeline(app)
+
+broadcaster = MenuBroadcaster(app)
+
+# answers retried POST /drinks, PATCH /drinks/<id> and POST /orders
+# carrying an Idempotency-Key from the first response
+idempotency = IdempotencyStore()
+idempotency.init_app(app)
+
+
+@app.cli.command('reset-db')
+@click.option('--yes', is_flag=True, help='do not ask for confirmation')
+def reset_db(yes):
+    """Drop every table and recreate an empty database."""
+    if yes or click.confirm('This deletes every drink. Continue?'):
+        db_drop_and_create_all()
+        click.echo('database reset')
+
+
+def menu_response(form):
+    etag, body = menu.get(form)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+def listing_args(form):
+    '''
+    the limit, cursor and fields of a drink listing, None when the whole
+    menu is asked for. aborts with 422 on invalid values
+    '''
+    if not any(arg in request.args for arg in ('limit', 'cursor', 'fields')):
+        return None
+    try:
+        limit = request.args.get('limit', None, type=int)
+        cursor = request.args.get('cursor', None, type=int)
+        if 'limit' in request.args and limit is None or \
+                'cursor' in request.args and cursor is None:
+            raise ValueError('limit and cursor must be integers')
+        if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError('limit out of range')
+        fields = None
+        if 'fields' in request.args:
+            fields = [field.strip() for field in request.args['fields'].split(',')]
+            if any(field not in FIELDS[form] for field in fields):
+                raise ValueError('unknown field')
+    except ValueError:
+        abort(422)
+    return {'fields': fields, 'limit': limit, 'cursor': cursor}
+
+
+def listing_response(form, args):
+    if args is None:
+        return menu_response(form)
+    drinks, nextCursor = menu_page(form, **args)
+    return jsonify({
+        'success': True,
+        'drinks': drinks,
+        'next_cursor': nextCursor
+    })
 
 # ROUTES
 @app.route('/drinks', methods=['GET'])
 def get_drinks_all():
+    # parsed outside the try: invalid arguments are a 422, not a 404
+    args = listing_args('short')
     try:
-        drinks = Drink.query.all()
-        formatted_drinks = [drink.short() for drink in drinks]
-
-        return jsonify({
-            'success': True,
-            'drinks': formatted_drinks
-        })
+        return listing_response('short', args)
 
     except Exception as e:
         abort(404)
 
+@app.route('/drinks/stream', methods=['GET'])
+def stream_menu_changes():
+    # EventSource sends the id of the last event it saw when reconnecting
+    lastEventId = request.headers.get('Last-Event-ID', None, type=int)
+    response = Response(broadcaster.stream(lastEventId),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # keeps nginx from buffering the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/drinks/search', methods=['GET'])
+def search_drinks_by_ingredient():
+    ingredients = request.args.getlist('ingredient')
+    match = request.args.get('match', 'all')
+    if not ingredients or match not in ('all', 'any'):
+        abort(422)
+
+    drinkIds = sorted(ingredient_index.search(ingredients, match))
+    drinks = []
+    # the matching drinks only, short form, stay below SQLite's parameter limit
+    for start in range(0, len(drinkIds), 500):
+        drinks.extend(db.session.query(Drink.id, Drink.title, Drink.short_recipe)
+                      .filter(Drink.id.in_(drinkIds[start:start + 500]))
+                      .order_by(Drink.id))
+
+    return jsonify({
+        'success': True,
+        'drinks': [{'id': drinkId, 'title': title, 'recipe': recipe}
+                   for drinkId, title, recipe in drinks]
+    })
+
 @app.route('/drinks-detail', methods=['GET'])
 @requires_auth('get:drinks-detail')
 def get_drinks_detail(token):
+    args = listing_args('long')
     try:
-        drinks = Drink.query.all()
-
-        return jsonify({
-            'success': True,
-            'drinks': [drink.long() for drink in drinks] # formattedDrinks !
-        })
+        return listing_response('long', args)
     except Exception as e:
         print(e)
         abort(401)
@@ -45,6 +147,7 @@ def get_drinks_detail(token):
 
 @app.route('/drinks', methods=['POST'])
 @requires_auth('post:drinks')
+@idempotency.idempotent
 def create_drink(payload):
     req = request.get_json()
     # validate data
@@ -54,7 +157,7 @@ def create_drink(payload):
         abort(422)
 
     try:
-        drink = Drink(title=title, recipe=json.dumps(recipe))
+        drink = Drink(title=title, recipe=recipe)
         drink.insert()
 
         return jsonify({
@@ -67,6 +170,7 @@ def create_drink(payload):
 
 @app.route('/drinks/<int:id>', methods=['PATCH'])
 @requires_auth('patch:drinks')
+@idempotency.idempotent
 def update_drink(payload, id):
     req = request.get_json()
     # issue the query
@@ -83,7 +187,7 @@ def update_drink(payload, id):
             drink.title = req_title
 
         if req_recipe:
-            drink.recipe = json.dumps(req['recipe'])
+            drink.recipe = req['recipe']
 
         drink.update()
     except BaseException:
@@ -91,6 +195,85 @@ def update_drink(payload, id):
 
     return jsonify({'success': True, 'drinks': [drink.long()]}), 200
 
+@app.route('/drinks/bulk', methods=['PUT'])
+@requires_auth('put:drinks-bulk')
+def upsert_drinks_bulk(payload):
+    req = request.get_json()
+    # a list of drinks, or {"drinks": [...]}
+    drinks = req.get('drinks') if isinstance(req, dict) else req
+    if not isinstance(drinks, list) or len(drinks) > MAX_BULK_DRINKS:
+        abort(422)
+    for drink in drinks:
+        if not isinstance(drink, dict) or not isinstance(drink.get('title'), str) \
+                or drink['title'] == '' or drink.get('recipe') is None:
+            abort(422)
+    if len({drink['title'] for drink in drinks}) != len(drinks):
+        abort(422)
+
+    try:
+        counts = upsert_drinks(drinks)
+    except BaseException:
+        abort(400)
+
+    return jsonify(dict(counts, success=True)), 200
+
+@app.route('/orders', methods=['POST'])
+@requires_auth('post:orders')
+@idempotency.idempotent
+def create_order(payload):
+    req = request.get_json()
+    try:
+        drinkId = int(req['drink_id'])
+        quantity = int(req.get('quantity', 1))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        abort(422)
+    if quantity < 1:
+        abort(422)
+
+    # the stock is taken in memory: the key is written on its own first
+    idempotency.claim()
+    try:
+        reference = orders.place(drinkId, quantity)
+    except LookupError:
+        abort(404)
+    except ValueError:
+        # the drink's recipe has parts that are not a number of units
+        abort(422)
+    except OutOfStock as e:
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "out of stock",
+            "ingredients": e.ingredients
+        }), 409
+    except OverflowError:
+        abort(503)
+
+    # accepted: the order is written by the batch writer shortly after
+    return jsonify({'success': True, 'order': reference}), 202
+
+@app.route('/inventory', methods=['GET'])
+@requires_auth('get:drinks-detail')
+def get_inventory(payload):
+    return jsonify({'success': True, 'inventory': orders.levels()})
+
+@app.route('/inventory', methods=['PATCH'])
+@requires_auth('patch:inventory')
+def update_inventory(payload):
+    req = request.get_json()
+    levels = req.get('ingredients') if isinstance(req, dict) else None
+    if not isinstance(levels, dict) or not levels or any(
+            isinstance(quantity, bool) or not isinstance(quantity, (int, float))
+            or quantity < 0 for quantity in levels.values()):
+        abort(422)
+
+    try:
+        orders.restock(levels)
+    except BaseException:
+        abort(400)
+
+    return jsonify({'success': True, 'inventory': orders.levels()})
+
 @app.route('/drinks/<int:id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
 def delete_drink(payload, id):
@@ -134,6 +317,24 @@ def auth_error(error):
     }), error.status_code
 
 
+@app.errorhandler(IdempotencyConflict)
+def idempotency_conflict(error):
+    return jsonify({
+        "success": False,
+        "error": 409,
+        "message": "a request with this Idempotency-Key is in progress"
+    }), 409
+
+
+@app.errorhandler(IdempotencyMismatch)
+def idempotency_mismatch(error):
+    return jsonify({
+        "success": False,
+        "error": 409,
+        "message": "Idempotency-Key reused with a different request"
+    }), 409
+
+
 @app.errorhandler(401)
 def unauthorized(error):
     return jsonify({
@@ -167,4 +368,13 @@ def method_not_allowed(error):
         "success": False,
         "error": 405,
         "message": 'Method Not Allowed'
-    }), 405
\ No newline at end of file
+    }), 405
+
+
+@app.errorhandler(503)
+def service_unavailable(error):
+    return jsonify({
+        "success": False,
+        "error": 503,
+        "message": 'Service Unavailable'
+    }), 503
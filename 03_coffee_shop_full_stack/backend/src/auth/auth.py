@@ -3,11 +3,21 @@ import json
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 
-AUTH0_DOMAIN = 'dev-6icr1d00.us.auth0.com'
+from .jwks import JWKSKeyStore, JWKSError
+from .token_cache import VerifiedTokenCache
+
+# the Auth0 tenant by default; point these at another issuer, e.g.
+# src/auth/local_issuer.py, to run without Auth0
+AUTH0_DOMAIN = environ.get('AUTH0_DOMAIN', 'dev-6icr1d00.us.auth0.com')
 ALGORITHMS = ['RS256']
-API_AUDIENCE = 'coffeshop'
+API_AUDIENCE = environ.get('API_AUDIENCE', 'coffeshop')
+AUTH0_ISSUER = environ.get('AUTH0_ISSUER', f'https://{AUTH0_DOMAIN}/')
+JWKS_URL = environ.get('JWKS_URL',
+                       f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+jwks = JWKSKeyStore(JWKS_URL)
+verifiedTokens = VerifiedTokenCache()
 
 # AuthError Exception
 
@@ -42,11 +52,14 @@ def get_token_auth_header():
 
     return headerParts[1]
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        abort(400)
+def check_permissions(permission, payload, permissions=None):
+    # permissions: the payload's permissions as a precomputed set
+    if permissions is None:
+        if 'permissions' not in payload:
+            abort(400)
+        permissions = frozenset(payload['permissions'])
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission Not found',
@@ -55,10 +68,6 @@ def check_permissions(permission, payload):
     return True
 
 def verify_decode_jwt(token):
-    # Get public key from Auth0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
     # data in the header
     unverifiedHeader = jwt.get_unverified_header(token)
 
@@ -69,18 +78,14 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed'
         }, 401)
 
-    rsa_key = {}
-
-    for key in jwks['keys']:
-        if key['kid'] == unverifiedHeader['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-            break
+    # public key from Auth0, cached by the key store
+    try:
+        rsa_key = jwks.get_key(unverifiedHeader['kid'])
+    except JWKSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
 
     # verify the token
     if rsa_key:
@@ -90,7 +95,7 @@ def verify_decode_jwt(token):
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer=f'https://{AUTH0_DOMAIN}/'
+                issuer=AUTH0_ISSUER
             )
             return payload
 
@@ -121,14 +126,22 @@ def verify_decode_jwt(token):
         'description': 'Unable to find the appropriate key.'
     }, 401)
 
+def verify_token(token):
+    # a token seen before is trusted until it expires, without checking
+    # its RS256 signature again
+    verified = verifiedTokens.get(token)
+    if verified is None:
+        verified = verifiedTokens.put(token, verify_decode_jwt(token))
+    return verified
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            verified = verify_token(token)
+            check_permissions(permission, verified.payload, verified.permissions)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
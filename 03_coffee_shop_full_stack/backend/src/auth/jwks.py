@@ -0,0 +1,150 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+
+class JWKSError(Exception):
+    pass
+
+
+class JWKSKeyStore:
+    '''
+    The identity provider's signing keys, fetched from its JWKS url and
+    cached by key id, so verifying a token needs no network round trip.
+
+    - keys are refreshed by a background thread before they are `ttl`
+      seconds old.
+    - once expired, the old keys keep being served while a refresh runs
+      (for up to `max_stale` seconds), so a slow or unreachable provider
+      does not hold up requests.
+    - an unknown key id (the provider rotated its keys) triggers an
+      immediate refetch, at most once every `refetch_interval` seconds so
+      tokens with made up key ids cannot hammer the provider.
+
+    `url` may be anything urlopen reads, including a file:// url.
+    '''
+
+    def __init__(self, url, ttl=600, refetch_interval=30, max_stale=86400,
+                 timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.refetchInterval = refetch_interval
+        self.maxStale = max_stale
+        self.timeout = timeout
+
+        self.keys = {}
+        self.fetchedAt = None
+        self.lastAttempt = None
+        self.lastFinished = None
+        self.lock = threading.Lock()
+        self.fetchLock = threading.Lock()
+        self.wakeUp = threading.Event()
+        self.refresher = None
+
+    def fetch(self, since=None):
+        '''
+        downloads the key set and replaces the cached keys. on failure the
+        cached keys are kept and JWKSError is raised.
+        with `since`, a time.monotonic() value, nothing is downloaded when
+        another fetch finished after it: callers that queued up behind that
+        fetch use its result instead of downloading again.
+        '''
+        with self.fetchLock:
+            if since is not None and (self.lastFinished or 0) > since:
+                return
+            self.lastAttempt = time.monotonic()
+            try:
+                with urlopen(self.url, timeout=self.timeout) as response:
+                    jwks = json.loads(response.read())
+                keys = {}
+                for key in jwks['keys']:
+                    if key.get('kty') != 'RSA' or 'kid' not in key:
+                        continue
+                    keys[key['kid']] = {
+                        'kty': key['kty'],
+                        'kid': key['kid'],
+                        'use': key.get('use', 'sig'),
+                        'n': key['n'],
+                        'e': key['e']
+                    }
+            except Exception as e:
+                raise JWKSError('unable to fetch {}: {}'.format(self.url, e))
+            finally:
+                self.lastFinished = time.monotonic()
+
+            with self.lock:
+                self.keys = keys
+                self.fetchedAt = time.monotonic()
+
+    def get_key(self, kid):
+        '''
+        the key with id `kid`, or None when the provider does not have it.
+        raises JWKSError when no usable keys can be obtained.
+        '''
+        self.start()
+        now = time.monotonic()
+        with self.lock:
+            key = self.keys.get(kid)
+            age = None if self.fetchedAt is None else now - self.fetchedAt
+
+        if age is None or age > self.ttl + self.maxStale:
+            # nothing cached, or too old to trust: the caller has to wait
+            self.fetch(since=now)
+            with self.lock:
+                key = self.keys.get(kid)
+                fetchedAt = self.fetchedAt
+            if fetchedAt is None or \
+                    time.monotonic() - fetchedAt > self.ttl + self.maxStale:
+                raise JWKSError('no usable keys from {}'.format(self.url))
+        elif age > self.ttl:
+            # serve what we have and let the refresher revalidate
+            self.wakeUp.set()
+        if key is not None:
+            return key
+
+        if now - (self.lastAttempt or 0) >= self.refetchInterval:
+            try:
+                self.fetch(since=now - self.refetchInterval)
+            except JWKSError:
+                pass
+            with self.lock:
+                key = self.keys.get(kid)
+        return key
+
+    def start(self):
+        '''
+        starts the background refresher, once per process.
+        '''
+        if self.refresher is not None and self.refresher.is_alive():
+            return
+        with self.lock:
+            if self.refresher is not None and self.refresher.is_alive():
+                return
+            self.refresher = threading.Thread(
+                target=self.refresh_forever, name='jwks-refresher', daemon=True)
+            self.refresher.start()
+
+    def refresh_forever(self):
+        while True:
+            with self.lock:
+                fetchedAt = self.fetchedAt
+            if fetchedAt is None:
+                wait = self.refetchInterval
+            else:
+                # refresh at 80% of the ttl, before anyone sees expired keys
+                wait = fetchedAt + self.ttl * 0.8 - time.monotonic()
+            if fetchedAt is None or wait > 0:
+                self.wakeUp.wait(max(wait, 0))
+            self.wakeUp.clear()
+
+            with self.lock:
+                fetchedAt = self.fetchedAt
+            if fetchedAt is not None and \
+                    time.monotonic() - fetchedAt < self.ttl * 0.8:
+                continue
+            try:
+                self.fetch()
+            except JWKSError:
+                # keep serving the cached keys, retry after a pause
+                time.sleep(min(self.refetchInterval, self.ttl))
@@ -0,0 +1,195 @@
+'''
+A stand-in for Auth0 to test and load-test the API offline.
+
+Mints RS256 tokens with the permissions you ask for and serves the matching
+JWKS document, so the API verifies them exactly like Auth0 tokens:
+
+    python -m src.auth.local_issuer --port 8089 --key issuer.pem
+
+prints the settings to start the API with. While it runs,
+`GET /token?permission=post:drinks&permission=patch:drinks` returns a token.
+'''
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from jose import jwt
+
+PERMISSIONS = [
+    'get:drinks-detail',
+    'post:drinks',
+    'patch:drinks',
+    'delete:drinks',
+    'put:drinks-bulk',
+    'post:orders',
+    'patch:inventory'
+]
+
+
+def generate_key():
+    '''
+    a new 2048 bit RSA private key as PEM.
+    '''
+    try:
+        from Crypto.PublicKey import RSA
+        return RSA.generate(2048).exportKey('PEM').decode('utf-8')
+    except ImportError:
+        import rsa
+        public, private = rsa.newkeys(2048)
+        return private.save_pkcs1().decode('utf-8')
+
+
+def public_numbers(pem):
+    '''
+    the modulus and public exponent of a PEM private key.
+    '''
+    try:
+        from Crypto.PublicKey import RSA
+        key = RSA.importKey(pem)
+        return key.n, key.e
+    except ImportError:
+        import rsa
+        key = rsa.PrivateKey.load_pkcs1(pem.encode('utf-8'))
+        return key.n, key.e
+
+
+def encode_number(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+class LocalIssuer:
+    '''
+    Signs tokens for `audience` as `issuer` with one RSA key.
+
+    `key_path` keeps the key in a PEM file: it is read when the file
+    exists and written otherwise, so a running API and a separate load test
+    can share the key. Without it a new key is generated.
+    '''
+
+    def __init__(self, issuer='http://127.0.0.1:8089/', audience='coffeshop',
+                 kid='local', key_path=None):
+        self.issuer = issuer
+        self.audience = audience
+        self.kid = kid
+
+        if key_path and os.path.exists(key_path):
+            with open(key_path) as keyFile:
+                self.privateKey = keyFile.read()
+        else:
+            self.privateKey = generate_key()
+            if key_path:
+                with open(key_path, 'w') as keyFile:
+                    keyFile.write(self.privateKey)
+        self.modulus, self.exponent = public_numbers(self.privateKey)
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': encode_number(self.modulus),
+            'e': encode_number(self.exponent)
+        }]}
+
+    def write_jwks(self, path):
+        '''
+        writes the JWKS document to `path` and returns its file:// url.
+        '''
+        with open(path, 'w') as jwksFile:
+            json.dump(self.jwks(), jwksFile)
+        return 'file://' + os.path.abspath(path)
+
+    def mint(self, permissions, subject=None, expires_in=3600):
+        '''
+        a signed token granting `permissions`, like the access tokens of
+        Auth0's RBAC.
+        '''
+        now = int(time.time())
+        return jwt.encode({
+            'iss': self.issuer,
+            'sub': subject or 'local|' + uuid.uuid4().hex,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }, self.privateKey, algorithm='RS256', headers={'kid': self.kid})
+
+    def environment(self, jwks_url):
+        '''
+        the settings making the API trust this issuer.
+        '''
+        return {
+            'AUTH0_ISSUER': self.issuer,
+            'API_AUDIENCE': self.audience,
+            'JWKS_URL': jwks_url
+        }
+
+    def serve(self, host='127.0.0.1', port=8089):
+        '''
+        starts serving the JWKS document and tokens on a background thread
+        and returns the server. port 0 picks a free port.
+        '''
+        issuer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/.well-known/jwks.json':
+                    self.send_json(issuer.jwks())
+                elif url.path == '/token':
+                    query = parse_qs(url.query)
+                    self.send_json({'access_token': issuer.mint(
+                        query.get('permission', []),
+                        subject=query.get('sub', [None])[0],
+                        expires_in=int(query.get('expires_in', [3600])[0]))})
+                else:
+                    self.send_error(404)
+
+            def send_json(self, body):
+                raw = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='local-issuer',
+                         daemon=True).start()
+        return server
+
+
+def main(arguments):
+    issuer = 'http://{}:{}/'.format(arguments.host, arguments.port)
+    local = LocalIssuer(issuer, arguments.audience, key_path=arguments.key)
+    server = local.serve(arguments.host, arguments.port)
+    for name, value in local.environment(issuer + '.well-known/jwks.json').items():
+        print('export {}={}'.format(name, value))
+    print('# token with every permission:')
+    print(local.mint(PERMISSIONS, subject='local|manager'))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local token issuer')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--audience', default='coffeshop')
+    parser.add_argument('--key', default=None,
+                        help='PEM file keeping the signing key between runs')
+    main(parser.parse_args())
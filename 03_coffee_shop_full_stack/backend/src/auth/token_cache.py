@@ -0,0 +1,61 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+'''
+a token whose signature and claims were checked, with its permissions as
+a set so permission checks are a hash lookup.
+'''
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions', 'expires'])
+
+
+class VerifiedTokenCache:
+    '''
+    Least recently used cache of verified tokens, keyed by the SHA-256 of
+    the raw token so the token itself is not kept around. An entry is
+    dropped once the token's `exp` has passed; tokens without `exp` are not
+    cached.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self.key(token)
+        with self.lock:
+            verified = self.entries.get(key)
+            if verified is None:
+                return None
+            if verified.expires <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return verified
+
+    def put(self, token, payload):
+        permissions = payload.get('permissions')
+        verified = VerifiedToken(
+            payload,
+            frozenset(permissions) if isinstance(permissions, list) else None,
+            payload.get('exp'))
+        if not isinstance(verified.expires, (int, float)):
+            return verified
+
+        key = self.key(token)
+        with self.lock:
+            self.entries[key] = verified
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return verified
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
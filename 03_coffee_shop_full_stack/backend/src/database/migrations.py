@@ -0,0 +1,94 @@
+import json
+import sys
+
+from sqlalchemy import create_engine
+
+'''
+Schema migrations of the coffee shop database.
+
+The schema version is kept in SQLite's `PRAGMA user_version`. Each
+migration upgrades the schema by one version and runs in the same
+transaction as the version bump. A fresh database built by create_all()
+is stamped with the latest version.
+
+Run from the backend directory to upgrade database.db in place:
+    python -m src.database.migrations
+'''
+
+
+def recipe_to_json(connection):
+    '''
+    1: recipe becomes a JSON column and gains the precomputed short_recipe.
+    SQLite keeps JSON as text, so recipes stay where they are. they are
+    normalized to a list of ingredients and short_recipe is backfilled.
+    '''
+    from .models import shorten_recipe
+
+    columns = [column[1] for column in connection.execute('PRAGMA table_info(drink)')]
+    if not columns:
+        return  # no drinks yet, create_all() builds the new schema
+    if 'short_recipe' not in columns:
+        connection.execute(
+            "ALTER TABLE drink ADD COLUMN short_recipe TEXT NOT NULL DEFAULT '[]'")
+    for drinkId, recipe in connection.execute('SELECT id, recipe FROM drink').fetchall():
+        recipe = json.loads(recipe)
+        if isinstance(recipe, dict):
+            recipe = [recipe]
+        connection.execute(
+            'UPDATE drink SET recipe = ?, short_recipe = ? WHERE id = ?',
+            (json.dumps(recipe), json.dumps(shorten_recipe(recipe)), drinkId))
+
+
+def inventory_leases(connection):
+    '''
+    2: inventory gains the parts leased to workers, see orders.py.
+    '''
+    columns = [column[1] for column in connection.execute('PRAGMA table_info(inventory)')]
+    if columns and 'leased' not in columns:
+        connection.execute(
+            "ALTER TABLE inventory ADD COLUMN leased FLOAT NOT NULL DEFAULT '0'")
+
+
+MIGRATIONS = [recipe_to_json, inventory_leases]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(connection):
+    return connection.execute('PRAGMA user_version').scalar()
+
+
+def set_version(connection, version):
+    # PRAGMA takes no bound parameters
+    connection.execute('PRAGMA user_version = {:d}'.format(version))
+
+
+def stamp(engine):
+    '''
+    marks a freshly created schema as up to date.
+    '''
+    with engine.begin() as connection:
+        set_version(connection, SCHEMA_VERSION)
+
+
+def upgrade(engine):
+    '''
+    applies the migrations the database has not seen yet.
+    returns the versions applied.
+    '''
+    applied = []
+    with engine.connect() as connection:
+        version = get_version(connection)
+    for version in range(version, SCHEMA_VERSION):
+        with engine.begin() as connection:
+            MIGRATIONS[version](connection)
+            set_version(connection, version + 1)
+        applied.append(version + 1)
+    return applied
+
+
+if __name__ == '__main__':
+    from .models import database_path
+
+    url = sys.argv[1] if len(sys.argv) > 1 else database_path
+    applied = upgrade(create_engine(url))
+    print('applied migrations: {}'.format(applied or 'none, already up to date'))
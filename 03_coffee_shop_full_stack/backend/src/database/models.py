@@ -1,23 +1,41 @@
 import os
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, Float, JSON, DateTime, ForeignKey, \
+    LargeBinary, Index
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import validates
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from .sqlite import sqlite_profile, engine_options, apply_profile, SerializedWriter
+
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
 database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filename))
 
 db = SQLAlchemy()
 
+# every drink write of this process goes through here, see sqlite.py
+writer = SerializedWriter()
+
 '''
-setup_db(app)
-    binds a flask application and a SQLAlchemy service
+setup_db(app, path)
+    binds a flask application and a SQLAlchemy service, to database_path
+    unless another database url is given
+    a SQLite file is opened with sqlite_profile: WAL journal, busy timeout
+    and a pool of connections shared by the threads
 '''
-def setup_db(app):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, path=None):
+    path = path or database_path
+    app.config["SQLALCHEMY_DATABASE_URI"] = path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    sqliteFile = path.startswith('sqlite:///') and not path.endswith(':memory:')
+    if sqliteFile:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(sqlite_profile)
     db.app = app
     db.init_app(app)
+    if sqliteFile:
+        with app.app_context():
+            apply_profile(db.engine, sqlite_profile)
 
 '''
 db_drop_and_create_all()
@@ -26,8 +44,106 @@ db_drop_and_create_all()
     !!NOTE you can change the database_filename variable to have multiple verisons of a database
 '''
 def db_drop_and_create_all():
+    from .migrations import stamp
+
+    try:
+        previous = menu_version.value
+    except OperationalError:
+        previous = 0  # no menu_state table yet
+    db.session.remove()
     db.drop_all()
     db.create_all()
+    stamp(db.engine)
+    # keep counting up, a worker still holding version `previous` reloads
+    db.session.add(MenuState(id=MENU_STATE_ID, version=previous + 1))
+    db.session.commit()
+    menu_version.notify(previous + 1, 'reset', None)
+
+'''
+db_create_or_upgrade()
+    creates the tables of a new database or applies the migrations an
+    existing one is missing, keeping its data. safe to run on every start
+'''
+def db_create_or_upgrade():
+    from .migrations import upgrade
+
+    upgrade(db.engine)
+    try:
+        db.create_all()
+    except OperationalError:
+        # another worker starting at the same time created the tables first
+        db.create_all()
+
+'''
+shorten_recipe(recipe)
+    the short form of a recipe, only the color and parts of each ingredient
+'''
+def shorten_recipe(recipe):
+    return [{'color': r['color'], 'parts': r['parts']} for r in recipe]
+
+MENU_STATE_ID = 1
+
+'''
+MenuState
+the row holding the menu version, see MenuVersion
+'''
+class MenuState(db.Model):
+    __tablename__ = 'menu_state'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+'''
+MenuVersion
+    the menu version, a counter in the menu_state row bumped in the same
+    transaction as every drink write. every worker reads the same version
+    from the database, so a cache of the menu in any of them knows when it
+    is stale, whichever worker wrote.
+    listeners registered with on_change are called in the process that
+    made the write, once it committed, with (version, action, drink) where
+    action is 'insert', 'update' or 'delete' and drink is the long form of
+    the drink written, 'bulk' with the long forms of all drinks created or
+    updated together, or 'reset' with no drink when all drinks were dropped.
+'''
+class MenuVersion:
+    def __init__(self):
+        self.listeners = []
+
+    def on_change(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    '''
+    value
+        the committed version, one primary key lookup. 0 before the first
+        write
+    '''
+    @property
+    def value(self):
+        version = db.session.query(MenuState.version)\
+            .filter(MenuState.id == MENU_STATE_ID).scalar()
+        return version or 0
+
+    '''
+    increment(session)
+        bumps the version inside the session's transaction, returns the new
+        version. the update takes SQLite's write lock, so workers bumping
+        together are serialized
+    '''
+    def increment(self, session):
+        updated = session.query(MenuState).filter(MenuState.id == MENU_STATE_ID)\
+            .update({MenuState.version: MenuState.version + 1},
+                    synchronize_session=False)
+        if not updated:
+            session.add(MenuState(id=MENU_STATE_ID, version=1))
+            return 1
+        return session.query(MenuState.version)\
+            .filter(MenuState.id == MENU_STATE_ID).scalar()
+
+    def notify(self, version, action, drink):
+        for listener in self.listeners:
+            listener(version, action, drink)
+
+menu_version = MenuVersion()
 
 '''
 Drink
@@ -38,21 +154,35 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
+    # the ingredients, stored as JSON and parsed once when the drink is loaded
     # the required datatype is [{'color': string, 'name':string, 'parts':number}]
-    recipe =  Column(String(180), nullable=False)
+    recipe = Column(JSON, nullable=False)
+    # shorten_recipe(recipe), computed whenever the recipe is set
+    short_recipe = Column(JSON, nullable=False)
+
+    '''
+    validate_recipe()
+        accepts a list of ingredients, a single ingredient or their JSON string
+        and keeps short_recipe in step
+    '''
+    @validates('recipe')
+    def validate_recipe(self, key, recipe):
+        if isinstance(recipe, str):
+            recipe = json.loads(recipe)
+        if isinstance(recipe, dict):
+            recipe = [recipe]
+        self.short_recipe = shorten_recipe(recipe)
+        return recipe
 
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': short_recipe
+            'recipe': self.short_recipe
         }
 
     '''
@@ -63,7 +193,7 @@ class Drink(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': self.recipe
         }
 
     '''
@@ -76,8 +206,8 @@ class Drink(db.Model):
             drink.insert()
     '''
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        version = writer.commit(db.session, self, 'insert', menu_version.increment)
+        menu_version.notify(version, 'insert', self.long())
 
     '''
     delete()
@@ -88,8 +218,9 @@ class Drink(db.Model):
             drink.delete()
     '''
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        drink = self.long()
+        version = writer.commit(db.session, self, 'delete', menu_version.increment)
+        menu_version.notify(version, 'delete', drink)
 
     '''
     update()
@@ -101,7 +232,114 @@ class Drink(db.Model):
             drink.update()
     '''
     def update(self):
-        db.session.commit()
+        version = writer.commit(db.session, self, 'update', menu_version.increment)
+        menu_version.notify(version, 'update', self.long())
 
     def __repr__(self):
-        return json.dumps(self.short())
\ No newline at end of file
+        return json.dumps(self.short())
+
+'''
+upsert_drinks(drinks)
+    creates or updates drinks by their unique title, in one transaction.
+    drinks is a list of {'title': ..., 'recipe': ...}. the menu version is
+    bumped once, in the same transaction, and only if something changed.
+    returns the number of drinks created, updated and unchanged
+'''
+def upsert_drinks(drinks):
+    def write():
+        titles = [drink['title'] for drink in drinks]
+        existing = {}
+        # stay below SQLite's limit of bound parameters per statement
+        for start in range(0, len(titles), 500):
+            for drink in Drink.query.filter(Drink.title.in_(titles[start:start + 500])):
+                existing[drink.title] = drink
+
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        written = []
+        for item in drinks:
+            drink = existing.get(item['title'])
+            if drink is None:
+                drink = Drink(title=item['title'], recipe=item['recipe'])
+                db.session.add(drink)
+                counts['created'] += 1
+            else:
+                previous = drink.recipe
+                drink.recipe = item['recipe']
+                if drink.recipe == previous:
+                    counts['unchanged'] += 1
+                    continue
+                counts['updated'] += 1
+            written.append(drink)
+        version = menu_version.increment(db.session) if written else None
+        return counts, written, version
+
+    counts, written, version = writer.run(db.session, write)
+    if written:
+        menu_version.notify(version, 'bulk', [drink.long() for drink in written])
+    return counts
+
+'''
+Order
+an order for a drink, persisted in batches by the order pipeline
+'''
+class Order(db.Model):
+    id = Column(Integer, primary_key=True)
+    # handed to the client when the order is accepted, before it is written
+    reference = Column(String(32), unique=True, nullable=False)
+    # orders outlive the drinks they were for
+    drink_id = Column(Integer, ForeignKey('drink.id', ondelete='SET NULL'), index=True)
+    quantity = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'reference': self.reference,
+            'drink_id': self.drink_id,
+            'quantity': self.quantity,
+            'created_at': self.created_at.isoformat()
+        }
+
+'''
+Inventory
+the stock of an ingredient in recipe parts. quantity is the stock no worker
+holds, leased what workers took in blocks and have not reported sold yet,
+see orders.py. ingredients without a row are not tracked
+'''
+class Inventory(db.Model):
+    ingredient = Column(String(80), primary_key=True)
+    quantity = Column(Float, nullable=False)
+    leased = Column(Float, nullable=False, default=0, server_default='0')
+
+    def format(self):
+        return {
+            'ingredient': self.ingredient,
+            'quantity': self.quantity,
+            'leased': self.leased
+        }
+
+'''
+IdempotencyKey
+an Idempotency-Key sent with a write request, see idempotency.py. inserted
+in the transaction of the request's write, status is null until the
+response is stored
+'''
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_key'
+    id = Column(Integer, primary_key=True)
+    caller = Column(String, nullable=False)
+    method = Column(String(10), nullable=False)
+    path = Column(String, nullable=False)
+    key = Column(String(255), nullable=False)
+    # sha256 of the query string and body
+    fingerprint = Column(String(64), nullable=False)
+    status = Column(Integer)
+    body = Column(LargeBinary)
+    mimetype = Column(String(100))
+    # seconds since the epoch
+    expires_at = Column(Float, nullable=False, index=True)
+
+    __table_args__ = (
+        Index('ix_idempotency_key_request', 'caller', 'method', 'path', 'key',
+              unique=True),
+    )
@@ -0,0 +1,150 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+'''
+sqlite_profile
+    how the SQLite file is opened, each setting can be overridden from the
+    environment:
+    SQLITE_JOURNAL_MODE   wal lets readers keep reading while a writer commits
+    SQLITE_BUSY_TIMEOUT   milliseconds a writer waits for the file lock
+    SQLITE_SYNCHRONOUS    normal is crash safe with wal and skips most fsyncs
+    SQLITE_POOL_SIZE      connections kept open between requests, more are
+                          opened under load and closed when handed back
+'''
+sqlite_profile = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'wal'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'normal'),
+    'pool_size': int(os.environ.get('SQLITE_POOL_SIZE', 64))
+}
+
+'''
+engine_options(profile)
+    create_engine options for a pool of connections shared by the threads
+    of a worker. a thread checks a connection out for the length of its
+    request, so a connection is only used by one thread at a time, but it
+    may be opened and closed by different ones
+'''
+def engine_options(profile=sqlite_profile):
+    return {
+        'poolclass': QueuePool,
+        'pool_size': profile['pool_size'],
+        'max_overflow': -1,
+        'connect_args': {
+            'timeout': profile['busy_timeout'] / 1000,
+            'check_same_thread': False
+        }
+    }
+
+'''
+apply_profile(engine, profile)
+    sets the profile's pragmas on every new connection of engine
+'''
+def apply_profile(engine, profile=sqlite_profile):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, record):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode = {}'.format(profile['journal_mode']))
+        cursor.execute('PRAGMA busy_timeout = {:d}'.format(profile['busy_timeout']))
+        cursor.execute('PRAGMA synchronous = {}'.format(profile['synchronous']))
+        cursor.close()
+
+'''
+is_locked(error)
+    whether an OperationalError is SQLite giving up on a busy database
+'''
+def is_locked(error):
+    message = str(error.orig)
+    return 'database is locked' in message or 'database is busy' in message
+
+'''
+SerializedWriter
+    the queue every commit of a worker goes through. writers are served one
+    at a time in arrival order, so threads of one worker never fight over
+    the file lock. across workers the busy timeout makes writers wait for
+    each other, and a commit that still finds the database locked is
+    replayed after a short pause instead of failing the request.
+
+    writes are run on the calling thread, which owns the session.
+'''
+class SerializedWriter:
+    def __init__(self, retries=5, backoff=0.05):
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.waiting = deque()
+        self.busy = False
+
+    def acquire(self):
+        turn = threading.Event()
+        with self.lock:
+            if not self.busy:
+                self.busy = True
+                return
+            self.waiting.append(turn)
+        turn.wait()
+
+    def release(self):
+        with self.lock:
+            if self.waiting:
+                self.waiting.popleft().set()
+            else:
+                self.busy = False
+
+    '''
+    run(session, write)
+        calls write() to make changes to the session and commits them. on a
+        replay write() is called again after the rollback, so it has to
+        rebuild all of its changes. returns what the last write() returned.
+        any error rolls the session back before it is raised
+    '''
+    def run(self, session, write):
+        self.acquire()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    result = write()
+                    session.commit()
+                    return result
+                except OperationalError as e:
+                    session.rollback()
+                    if not is_locked(e) or attempt == self.retries:
+                        raise
+                except BaseException:
+                    session.rollback()
+                    raise
+                time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+        finally:
+            self.release()
+
+    '''
+    commit(session, instance, action, then)
+        commits the session, where action is what was done to instance:
+        'insert', 'update' or 'delete'. on a replay the instance's changes
+        are applied again after the rollback. then(session), when given,
+        makes more changes in the same transaction and its result is
+        returned
+    '''
+    def commit(self, session, instance, action, then=None):
+        state = inspect(instance)
+        changes = {attribute.key: attribute.value for attribute in state.attrs
+                   if attribute.history.has_changes()}
+
+        def write():
+            for key, value in changes.items():
+                setattr(instance, key, value)
+            if action == 'insert':
+                session.add(instance)
+            elif action == 'delete':
+                session.delete(instance)
+            if then is not None:
+                return then(session)
+
+        return self.run(session, write)
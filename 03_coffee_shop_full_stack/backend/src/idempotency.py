@@ -0,0 +1,243 @@
+import hashlib
+import time
+from functools import wraps
+
+from flask import Response, request, g, abort, has_request_context
+from sqlalchemy import event
+
+from .auth.auth import get_token_auth_header
+from .database.models import db, writer, IdempotencyKey
+
+IDEMPOTENCY_TTL = 24 * 3600
+# a key whose request never finished, e.g. its worker died, is free again
+# after this many seconds
+IN_PROGRESS_TTL = 60
+PURGE_INTERVAL = 60
+MAX_KEY_LENGTH = 255
+
+'''
+IdempotencyConflict
+    raised when a request comes in while one with the same key is still
+    being handled
+'''
+class IdempotencyConflict(Exception):
+    pass
+
+'''
+IdempotencyMismatch
+    raised when a key is reused for a request with a different body
+'''
+class IdempotencyMismatch(Exception):
+    pass
+
+'''
+PendingKey
+    the key of the request being handled, until its row is committed
+'''
+class PendingKey:
+    __slots__ = ('row', 'flushed', 'claimed')
+
+    def __init__(self, row):
+        self.row = row
+        self.flushed = False
+        self.claimed = False
+
+'''
+IdempotencyStore
+    responses of write requests sent with an Idempotency-Key header, so a
+    client retrying after a dropped connection gets the first answer back
+    instead of writing again. keys are scoped by the caller (see caller()),
+    the method and the path, and kept for ttl seconds.
+
+    the keys live in the idempotency_key table. a request's key row is
+    added to the first transaction the request commits, next to the drink
+    it writes, and the unique index makes a retry running at the same time
+    on any worker fail its own write. a view that commits nothing of its
+    own, like POST /orders, calls claim() before making its change. the
+    response is stored in the row once it is sent.
+
+    only successful (2xx) responses are stored. after a rejection, e.g. an
+    order out of stock, the row is deleted and the request can be retried
+    with the same key once the cause is gone.
+'''
+class IdempotencyStore:
+    def __init__(self, ttl=IDEMPOTENCY_TTL):
+        self.ttl = ttl
+        self.lastPurge = 0
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        event.listen(db.session, 'before_flush', self.before_flush)
+        event.listen(db.session, 'after_flush', self.after_flush)
+        event.listen(db.session, 'after_commit', self.after_commit)
+        event.listen(db.session, 'after_rollback', self.after_rollback)
+
+    @staticmethod
+    def pending():
+        if not has_request_context():
+            return None
+        return g.get('idempotency_key')
+
+    def before_flush(self, session, flush_context, instances):
+        pending = self.pending()
+        if pending is not None and not pending.claimed and pending.row not in session:
+            session.add(pending.row)
+
+    def after_flush(self, session, flush_context):
+        pending = self.pending()
+        if pending is not None and not pending.claimed:
+            pending.flushed = pending.flushed or pending.row in session
+
+    def after_commit(self, session):
+        pending = self.pending()
+        if pending is not None and pending.flushed:
+            pending.claimed = True
+
+    def after_rollback(self, session):
+        pending = self.pending()
+        if pending is not None and not pending.claimed:
+            pending.flushed = False
+
+    '''
+    lookup(key, fingerprint)
+        the stored response of key, or None when no request holds it.
+        raises IdempotencyConflict while its request is running and
+        IdempotencyMismatch when it was used with another fingerprint
+    '''
+    def lookup(self, key, fingerprint):
+        caller, method, path, idempotencyKey = key
+        row = IdempotencyKey.query.filter(
+            IdempotencyKey.caller == caller, IdempotencyKey.method == method,
+            IdempotencyKey.path == path, IdempotencyKey.key == idempotencyKey
+        ).one_or_none()
+        if row is None:
+            return None
+        if row.expires_at <= time.time():
+            # frees the key for this request
+            expired = row.id
+            writer.run(db.session, lambda: IdempotencyKey.query.filter(
+                IdempotencyKey.id == expired, IdempotencyKey.expires_at <= time.time()
+            ).delete(synchronize_session=False))
+            return None
+        if row.fingerprint != fingerprint:
+            raise IdempotencyMismatch(key)
+        if row.status is None:
+            raise IdempotencyConflict(key)
+        return row.body, row.status, row.mimetype
+
+    '''
+    claim()
+        commits the key of the current request on its own, for views that
+        change nothing in the database before their answer. raises
+        IntegrityError when another request holds the key
+    '''
+    def claim(self):
+        pending = self.pending()
+        if pending is not None and not pending.claimed:
+            writer.run(db.session, lambda: db.session.add(pending.row))
+
+    def finish(self, pending, response):
+        row = pending.row
+        # only status, body and content type: the rest is added per request
+        body, status, mimetype = response.get_data(), response.status_code, response.mimetype
+        now = time.time()
+
+        def write():
+            IdempotencyKey.query.filter(IdempotencyKey.id == row.id).update({
+                IdempotencyKey.status: status,
+                IdempotencyKey.body: body,
+                IdempotencyKey.mimetype: mimetype,
+                IdempotencyKey.expires_at: now + self.ttl
+            }, synchronize_session=False)
+            if now - self.lastPurge > PURGE_INTERVAL:
+                IdempotencyKey.query.filter(IdempotencyKey.expires_at <= now)\
+                    .delete(synchronize_session=False)
+
+        writer.run(db.session, write)
+        self.lastPurge = max(self.lastPurge, now)
+
+    def abandon(self, pending):
+        rowId = pending.row.id
+        writer.run(db.session, lambda: IdempotencyKey.query.filter(
+            IdempotencyKey.id == rowId).delete(synchronize_session=False))
+
+    def after_request(self, response):
+        pending = g.pop('idempotency_key', None)
+        if pending is not None and pending.claimed:
+            if 200 <= response.status_code < 300 and not response.is_streamed:
+                self.finish(pending, response)
+            else:
+                self.abandon(pending)
+        return response
+
+    def teardown_request(self, error):
+        # the request failed before a response was made
+        pending = g.pop('idempotency_key', None)
+        if pending is not None and pending.claimed:
+            self.abandon(pending)
+
+    '''
+    caller(payload)
+        who sent the request: the token's subject, else the client it was
+        issued to, else the token itself, so callers without a subject
+        never share keys
+    '''
+    @staticmethod
+    def caller(payload):
+        for claim in ('sub', 'azp', 'client_id'):
+            if payload.get(claim):
+                return '{}:{}'.format(claim, payload[claim])
+        token = get_token_auth_header().encode('utf-8')
+        return 'token:' + hashlib.sha256(token).hexdigest()
+
+    @staticmethod
+    def replay(stored):
+        body, status, mimetype = stored
+        response = Response(body, status=status, mimetype=mimetype)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    '''
+    idempotent(f)
+        decorates a view under requires_auth so that a request repeating
+        the Idempotency-Key of an earlier one is answered with the stored
+        response without calling the view. requests without the header are
+        handled as usual
+    '''
+    def idempotent(self, f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            idempotencyKey = request.headers.get('Idempotency-Key')
+            if idempotencyKey is None:
+                return f(payload, *args, **kwargs)
+            if not idempotencyKey or len(idempotencyKey) > MAX_KEY_LENGTH:
+                abort(422)
+
+            key = (self.caller(payload), request.method, request.path, idempotencyKey)
+            fingerprint = hashlib.sha256(
+                request.query_string + b'?' + request.get_data()).hexdigest()
+            stored = self.lookup(key, fingerprint)
+            if stored is not None:
+                return self.replay(stored)
+
+            caller, method, path, _ = key
+            pending = PendingKey(IdempotencyKey(
+                caller=caller, method=method, path=path, key=idempotencyKey,
+                fingerprint=fingerprint, expires_at=time.time() + IN_PROGRESS_TTL))
+            g.idempotency_key = pending
+            try:
+                return f(payload, *args, **kwargs)
+            except Exception:
+                if pending.claimed:
+                    raise
+                # the write failed, maybe on the key: a request with the
+                # same key committed first
+                g.pop('idempotency_key', None)
+                db.session.rollback()
+                stored = self.lookup(key, fingerprint)
+                if stored is not None:
+                    return self.replay(stored)
+                raise
+
+        return wrapper
@@ -0,0 +1,94 @@
+import threading
+
+from .database.models import db, Drink, menu_version
+
+'''
+normalize_ingredient(name)
+    the indexed form of an ingredient name: case folded, single spaced
+'''
+def normalize_ingredient(name):
+    return ' '.join(str(name).casefold().split())
+
+'''
+IngredientIndex
+    an inverted index from ingredient name to the ids of the drinks using
+    it, so "all drinks with oat milk" is a dict lookup and combining
+    ingredients is a set intersection or union. it is built from the
+    database on first use and kept in step by the menu change listener.
+    every search compares the index with the menu version in the database;
+    when another worker wrote a drink in between, the index is rebuilt.
+'''
+class IngredientIndex:
+    def __init__(self):
+        self.drinks = {}
+        self.index = {}
+        self.lock = threading.Lock()
+        # the menu version the index reflects, None when it has to be built
+        self.version = None
+
+    def load(self):
+        # read the version first: a write racing with the query leaves the
+        # index one version behind and it is rebuilt on the next search
+        version = menu_version.value
+        with self.lock:
+            if self.version == version:
+                return
+            self.drinks.clear()
+            self.index.clear()
+            for drinkId, recipe in db.session.query(Drink.id, Drink.recipe):
+                self.add(drinkId, recipe)
+            self.version = version
+
+    def add(self, drinkId, recipe):
+        self.remove(drinkId)
+        names = {normalize_ingredient(ingredient['name']) for ingredient in recipe
+                 if isinstance(ingredient, dict) and ingredient.get('name')}
+        self.drinks[drinkId] = names
+        for name in names:
+            self.index.setdefault(name, set()).add(drinkId)
+
+    def remove(self, drinkId):
+        for name in self.drinks.pop(drinkId, ()):
+            drinkIds = self.index[name]
+            drinkIds.discard(drinkId)
+            if not drinkIds:
+                del self.index[name]
+
+    '''
+    search(ingredients, match)
+        ids of the drinks containing all ('all') or any ('any') of the
+        ingredients
+    '''
+    def search(self, ingredients, match='all'):
+        self.load()
+        with self.lock:
+            sets = [self.index.get(normalize_ingredient(name), set())
+                    for name in ingredients]
+            if not sets:
+                return set()
+            if match == 'any':
+                return set().union(*sets)
+            # smallest first keeps the intersection cheap
+            sets.sort(key=len)
+            return sets[0].intersection(*sets[1:])
+
+    def on_menu_change(self, version, action, drink):
+        with self.lock:
+            if self.version != version - 1:
+                # not built yet, or a write of another worker was missed
+                self.version = None
+                return
+            self.version = version
+            if action == 'reset':
+                self.drinks.clear()
+                self.index.clear()
+            elif action == 'delete':
+                self.remove(drink['id'])
+            elif action == 'bulk':
+                for written in drink:
+                    self.add(written['id'], written['recipe'])
+            else:
+                self.add(drink['id'], drink['recipe'])
+
+ingredient_index = IngredientIndex()
+menu_version.on_change(ingredient_index.on_menu_change)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+
+from sqlalchemy.orm import load_only
+
+from .database.models import db, Drink, menu_version
+
+MAX_PAGE_SIZE = 100
+
+'''
+FIELDS
+    the column behind each field a client can ask for, per form
+'''
+FIELDS = {
+    'short': {'id': Drink.id, 'title': Drink.title, 'recipe': Drink.short_recipe},
+    'long': {'id': Drink.id, 'title': Drink.title, 'recipe': Drink.recipe}
+}
+
+'''
+MenuCache
+    the /drinks and /drinks-detail responses, serialized once per menu
+    version. a hit reads the version from the database, one primary key
+    lookup, and compares it: no drink is read and no JSON encoded. since the
+    version is in the database, a write by any worker makes the snapshots
+    of every worker stale. they are rebuilt lazily on the first read after
+    a write.
+'''
+class MenuCache:
+    FORMS = {
+        'short': (('id', 'title', 'short_recipe'), Drink.short),
+        'long': (('id', 'title', 'recipe'), Drink.long)
+    }
+
+    def __init__(self, version=menu_version):
+        self.version = version
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    '''
+    get(form)
+        returns (etag, body) of the menu in 'short' or 'long' form
+    '''
+    def get(self, form):
+        # read the version first: a write racing with the query leaves the
+        # snapshot one version behind and it is rebuilt next time
+        version = self.version.value
+        snapshot = self.snapshots.get(form)
+        if snapshot is not None and snapshot[0] == version:
+            return snapshot[1], snapshot[2]
+
+        with self.lock:
+            snapshot = self.snapshots.get(form)
+            if snapshot is None or snapshot[0] != version:
+                snapshot = self.build(form, version)
+                self.snapshots[form] = snapshot
+        return snapshot[1], snapshot[2]
+
+    '''
+    preload()
+        builds the snapshots of every form, e.g. before serving requests
+    '''
+    def preload(self):
+        for form in self.FORMS:
+            self.get(form)
+
+    def build(self, form, version):
+        columns, serialize = self.FORMS[form]
+        drinks = Drink.query.options(load_only(*columns)).order_by(Drink.id).all()
+        body = json.dumps({
+            'success': True,
+            'drinks': [serialize(drink) for drink in drinks]
+        }, separators=(',', ':')).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        return version, etag, body
+
+
+'''
+menu_page(form, fields, limit, cursor)
+    the drinks after the id `cursor`, at most `limit` of them, with only the
+    given fields. only the columns of those fields are selected.
+    returns the drinks and the cursor of the next page, None on the last one
+'''
+def menu_page(form, fields=None, limit=None, cursor=None):
+    fields = fields or list(FIELDS[form])
+    columns = [FIELDS[form][field] for field in fields]
+    query = db.session.query(Drink.id, *columns).order_by(Drink.id)
+    if cursor is not None:
+        query = query.filter(Drink.id > cursor)
+    if limit is not None:
+        # one extra row tells whether there is a next page
+        query = query.limit(limit + 1)
+    rows = query.all()
+
+    nextCursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        nextCursor = rows[-1][0]
+    return [dict(zip(fields, row[1:])) for row in rows], nextCursor
@@ -0,0 +1,307 @@
+import atexit
+import threading
+import uuid
+from collections import deque
+from datetime import datetime
+
+from .database.models import db, writer, menu_version, Drink, Order, Inventory
+from .ingredients import normalize_ingredient
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5
+MAX_BUFFERED_ORDERS = 100000
+LEASE_SIZE = 50
+
+'''
+OutOfStock
+    raised when an order needs more of an ingredient than is left
+'''
+class OutOfStock(Exception):
+    def __init__(self, ingredients):
+        self.ingredients = ingredients
+
+'''
+recipe_needs(recipe)
+    the parts of each ingredient one drink takes. raises ValueError when
+    the parts of an ingredient are not an integer
+'''
+def recipe_needs(recipe):
+    needs = {}
+    for ingredient in recipe:
+        if isinstance(ingredient, dict) and ingredient.get('name'):
+            parts = ingredient.get('parts', 0)
+            if isinstance(parts, bool) or not isinstance(parts, int):
+                raise ValueError('parts of {!r} must be an integer'.format(
+                    ingredient['name']))
+            name = normalize_ingredient(ingredient['name'])
+            needs[name] = needs.get(name, 0) + parts
+    return needs
+
+'''
+lease_stock(session, name, wanted)
+    moves stock of an ingredient from the inventory to the leases of the
+    calling worker: a block of LEASE_SIZE parts, or `wanted` when more,
+    else all that is left when it covers `wanted`. returns the parts leased,
+    0 when less than `wanted` is left and None when the ingredient is not
+    tracked
+'''
+def lease_stock(session, name, wanted):
+    block = max(wanted, LEASE_SIZE)
+    leased = session.query(Inventory)\
+        .filter(Inventory.ingredient == name, Inventory.quantity >= block)\
+        .update({Inventory.quantity: Inventory.quantity - block,
+                 Inventory.leased: Inventory.leased + block},
+                synchronize_session=False)
+    if leased:
+        return block
+
+    # the update took the write lock, the level read now cannot move
+    left = session.query(Inventory.quantity)\
+        .filter(Inventory.ingredient == name).scalar()
+    if left is None:
+        return None
+    if left < wanted:
+        return 0
+    session.query(Inventory).filter(Inventory.ingredient == name)\
+        .update({Inventory.quantity: 0, Inventory.leased: Inventory.leased + left},
+                synchronize_session=False)
+    return left
+
+'''
+OrderPipeline
+    order intake. place() takes the stock an order needs from the stock this
+    worker leased and appends the order to a buffer; a background thread
+    writes the buffer every FLUSH_INTERVAL seconds (or as soon as BATCH_SIZE
+    orders are waiting) with one multi-row insert per batch.
+
+    stock is leased from the inventory table in blocks of LEASE_SIZE parts
+    with a conditional update, so workers can never lease more than is
+    left, and taken from the lease in memory: only one order in a block
+    waits for the database. after each flush the parts sold are written
+    back to the table and the leases of ingredients that sold nothing since
+    the last pass are given back, so an idle worker does not sit on stock
+    the others need.
+
+    orders still in the buffer are lost if the process dies, and so is the
+    stock it leased; a crash can undercount the inventory but never oversell
+    it.
+'''
+class OrderPipeline:
+    def __init__(self, app, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.app = app
+        self.batchSize = batch_size
+        self.flushInterval = flush_interval
+        self.buffer = deque()
+        self.wakeup = threading.Event()
+        self.flushLock = threading.Lock()
+        self.worker = None
+        self.stockLock = threading.Lock()
+        # parts leased and not sold yet, parts sold since the last checkpoint
+        self.held = {}
+        self.sold = {}
+        # ingredients without an inventory row, forgotten at every checkpoint
+        self.untracked = set()
+        menu_version.on_change(self.on_menu_change)
+
+    def on_menu_change(self, version, action, drink):
+        if action == 'reset':
+            # the inventory table was dropped with the leases in it
+            with self.stockLock:
+                self.held.clear()
+                self.sold.clear()
+                self.untracked.clear()
+
+    '''
+    place(drink_id, quantity)
+        accepts an order and takes its stock. returns its reference. raises
+        LookupError for an unknown drink, ValueError when the drink's recipe
+        has invalid parts and OutOfStock when an ingredient ran short
+    '''
+    def place(self, drink_id, quantity=1):
+        recipe = db.session.query(Drink.recipe).filter(Drink.id == drink_id).scalar()
+        if recipe is None:
+            raise LookupError(drink_id)
+        needs = {name: parts * quantity for name, parts
+                 in recipe_needs(recipe).items() if parts}
+        if len(self.buffer) >= MAX_BUFFERED_ORDERS:
+            raise OverflowError('order buffer full')
+
+        if needs:
+            self.take(needs)
+
+        reference = uuid.uuid4().hex
+        self.buffer.append({
+            'reference': reference,
+            'drink_id': drink_id,
+            'quantity': quantity,
+            'created_at': datetime.utcnow()
+        })
+        if self.worker is None:
+            self.start()
+        if len(self.buffer) >= self.batchSize:
+            self.wakeup.set()
+        return reference
+
+    def missing(self, needs):
+        return {name: parts - self.held.get(name, 0) for name, parts in needs.items()
+                if name not in self.untracked and self.held.get(name, 0) < parts}
+
+    def take(self, needs):
+        with self.stockLock:
+            wanted = self.missing(needs)
+            if wanted:
+                def write():
+                    return {name: lease_stock(db.session, name, parts)
+                            for name, parts in wanted.items()}
+
+                for name, leased in writer.run(db.session, write).items():
+                    if leased is None:
+                        self.untracked.add(name)
+                    else:
+                        self.held[name] = self.held.get(name, 0) + leased
+
+            short = sorted(self.missing(needs))
+            if short:
+                # the leases taken for the other ingredients are kept
+                raise OutOfStock(short)
+            for name, parts in needs.items():
+                if name not in self.untracked:
+                    self.held[name] -= parts
+                    self.sold[name] = self.sold.get(name, 0) + parts
+
+    '''
+    checkpoint(release)
+        writes the parts sold since the last checkpoint and gives back the
+        leases of ingredients that sold nothing since, or all of them when
+        release is true
+    '''
+    def checkpoint(self, release=False):
+        with self.stockLock:
+            sold, self.sold = self.sold, {}
+            returned = {name: parts for name, parts in self.held.items()
+                        if release or name not in sold}
+            for name in returned:
+                del self.held[name]
+            self.untracked.clear()
+        if not sold and not returned:
+            return
+
+        def write():
+            for name in set(sold) | set(returned):
+                db.session.query(Inventory).filter(Inventory.ingredient == name)\
+                    .update({Inventory.quantity: Inventory.quantity + returned.get(name, 0),
+                             Inventory.leased: Inventory.leased - sold.get(name, 0)
+                             - returned.get(name, 0)},
+                            synchronize_session=False)
+
+        try:
+            writer.run(db.session, write)
+        except Exception:
+            with self.stockLock:
+                for name, parts in sold.items():
+                    self.sold[name] = self.sold.get(name, 0) + parts
+                for name, parts in returned.items():
+                    self.held[name] = self.held.get(name, 0) + parts
+            raise
+
+    '''
+    restock(levels)
+        sets the stock of the given ingredients. the parts other workers
+        leased count towards the new level: when they hold more than it,
+        quantity goes below zero until they give the rest back. this
+        worker's leases are given back
+    '''
+    def restock(self, levels):
+        levels = {normalize_ingredient(name): quantity for name, quantity in levels.items()}
+        with self.stockLock:
+            own = {name: self.held.get(name, 0) + self.sold.get(name, 0) for name in levels}
+
+            def write():
+                for name, quantity in levels.items():
+                    # SET expressions see the row as it was before the update
+                    updated = db.session.query(Inventory)\
+                        .filter(Inventory.ingredient == name)\
+                        .update({Inventory.leased: Inventory.leased - own[name],
+                                 Inventory.quantity:
+                                     quantity - (Inventory.leased - own[name])},
+                                synchronize_session=False)
+                    if not updated:
+                        db.session.add(Inventory(ingredient=name, quantity=quantity,
+                                                 leased=0))
+
+            writer.run(db.session, write)
+            for name in levels:
+                self.held.pop(name, None)
+                self.sold.pop(name, None)
+                self.untracked.discard(name)
+
+    '''
+    levels()
+        the stock left of every tracked ingredient, leased or not. what
+        other workers sold since their last checkpoint is still counted
+    '''
+    def levels(self):
+        rows = db.session.query(Inventory.ingredient, Inventory.quantity,
+                                Inventory.leased).all()
+        with self.stockLock:
+            sold = dict(self.sold)
+        return {ingredient: quantity + leased - sold.get(ingredient, 0)
+                for ingredient, quantity, leased in rows}
+
+    def start(self):
+        with self.flushLock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self.run, daemon=True,
+                                           name='order-writer')
+            self.worker.start()
+            atexit.register(self.close)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self.flush()
+                    self.checkpoint()
+                except Exception:
+                    self.app.logger.exception('order flush failed')
+                finally:
+                    db.session.remove()
+
+    def close(self):
+        # at exit: write the last orders and give the leases back
+        with self.app.app_context():
+            try:
+                self.flush()
+                self.checkpoint(release=True)
+            finally:
+                db.session.remove()
+
+    '''
+    flush()
+        writes everything buffered so far. returns the number of orders
+        written
+    '''
+    def flush(self):
+        with self.flushLock:
+            written = 0
+            while self.buffer:
+                batch = []
+                while self.buffer and len(batch) < self.batchSize:
+                    batch.append(self.buffer.popleft())
+                written += self.write(batch)
+            return written
+
+    def write(self, batch):
+        def write():
+            db.session.bulk_insert_mappings(Order, batch)
+            return len(batch)
+
+        try:
+            return writer.run(db.session, write)
+        except Exception:
+            if len(self.buffer) < MAX_BUFFERED_ORDERS:
+                self.buffer.extendleft(reversed(batch))
+            raise
@@ -0,0 +1,115 @@
+import json
+import threading
+
+from .database.models import db, menu_version
+
+HEARTBEAT_INTERVAL = 15
+POLL_INTERVAL = 1
+
+'''
+format_event(event)
+    an event in the text/event-stream format, its id is the menu version
+'''
+def format_event(event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event['version'], event['type'], json.dumps(event))
+
+'''
+MenuBroadcaster
+    tells every open /drinks/stream when the menu changed. the menu version
+    in the menu_state row is the source of the changes and the id of the
+    events: it is shared by all workers, so a stream hears about writes
+    made by any of them and a client can reconnect to any worker with
+    Last-Event-ID.
+
+    one thread per process reads the version every POLL_INTERVAL seconds,
+    writes made by this process are announced as soon as they commit.
+    every stream waits on one condition for the version to move, so an
+    idle stream costs a blocked generator. a stream that misses versions
+    while the client is slow or away just sends the latest one: a change
+    event means "reload the menu", not a diff to apply.
+'''
+class MenuBroadcaster:
+    def __init__(self, app, version=menu_version, poll_interval=POLL_INTERVAL,
+                 heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.app = app
+        self.menuVersion = version
+        self.pollInterval = poll_interval
+        self.heartbeatInterval = heartbeat_interval
+        self.changed = threading.Condition()
+        # the last version read, None before the first read
+        self.version = None
+        self.poller = None
+        self.stopped = threading.Event()
+        version.on_change(self.on_menu_change)
+
+    def on_menu_change(self, version, action, drink):
+        self.publish(version)
+
+    def publish(self, version):
+        with self.changed:
+            # versions only go up, a late poll must not take back a write
+            if self.version is None or version > self.version:
+                self.version = version
+                self.changed.notify_all()
+
+    '''
+    refresh()
+        reads the version from the database in the caller's app context
+        and announces it when it moved
+    '''
+    def refresh(self):
+        self.publish(self.menuVersion.value)
+
+    def start(self):
+        with self.changed:
+            if self.poller is not None:
+                return
+            self.poller = threading.Thread(target=self.run, daemon=True,
+                                           name='menu-version-poller')
+            self.poller.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.pollInterval):
+            with self.app.app_context():
+                try:
+                    self.refresh()
+                except Exception:
+                    self.app.logger.exception('menu version poll failed')
+                finally:
+                    db.session.remove()
+
+    '''
+    stream(last_event_id)
+        the text/event-stream of menu changes, as a generator. a client
+        behind last_event_id's version gets a changed event at once, one
+        ahead of it a reset. sends a comment
+        line every heartbeat interval to keep proxies from closing the
+        stream. needs an app context, the generator does not
+    '''
+    def stream(self, last_event_id=None):
+        self.start()
+        self.refresh()
+        with self.changed:
+            current = self.version
+        return self.events(current, current if last_event_id is None else last_event_id)
+
+    def events(self, current, sent):
+        yield 'retry: 3000\n\n'
+        if sent > current:
+            # an id this menu never had, e.g. from a database since replaced
+            yield format_event({'type': 'reset', 'version': current})
+            sent = current
+        while True:
+            with self.changed:
+                if self.version <= sent:
+                    self.changed.wait(self.heartbeatInterval)
+                version = self.version
+            if version > sent:
+                yield format_event({'type': 'changed', 'version': version})
+                sent = version
+            else:
+                yield ': heartbeat\n\n'
@@ -0,0 +1,552 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
+
+from jose import jwt
+
+from src import orders
+from src.auth import auth
+from src.auth.jwks import JWKSKeyStore
+from src.auth.local_issuer import LocalIssuer, PERMISSIONS
+from src.database import models
+
+# signs tokens the default issuer and audience of auth.py accept
+issuer = LocalIssuer(auth.AUTH0_ISSUER, auth.API_AUDIENCE)
+api = None
+
+
+def setUpModule():
+    '''
+    imports the API on a database in a temporary directory, trusting the
+    local issuer's keys from a file:// JWKS
+    '''
+    global api, directory, jwksPatcher
+    directory = tempfile.mkdtemp()
+    jwksPatcher = mock.patch.object(auth, 'jwks', JWKSKeyStore(
+        issuer.write_jwks(os.path.join(directory, 'jwks.json'))))
+    jwksPatcher.start()
+
+    # the database path is read at import
+    models.database_path = 'sqlite:///{}'.format(os.path.join(directory, 'api.db'))
+    from src import api
+
+
+def tearDownModule():
+    jwksPatcher.stop()
+    # gives the leases back while the database is still there
+    api.orders.close()
+    api.broadcaster.stop()
+    with api.app.app_context():
+        models.db.session.remove()
+        models.db.get_engine(api.app).dispose()
+    shutil.rmtree(directory)
+
+
+def recipe(*names):
+    return [{'name': name, 'color': 'brown', 'parts': 1} for name in names]
+
+
+class CoffeeShopTestCase(unittest.TestCase):
+    """This class represents the coffee shop API test case"""
+
+    def setUp(self):
+        with api.app.app_context():
+            # orders of the previous test are written before the reset
+            api.orders.flush()
+            models.db_drop_and_create_all()
+        self.client = api.app.test_client()
+        self.token = issuer.mint(PERMISSIONS, subject='local|manager')
+
+    def auth(self, token=None):
+        return {'Authorization': 'Bearer ' + (token or self.token)}
+
+    def add_drinks(self, count, prefix='drink'):
+        ids = []
+        for number in range(count):
+            res = self.client.post('/drinks', headers=self.auth(), json={
+                'title': '{} {}'.format(prefix, number),
+                'recipe': recipe('coffee')})
+            ids.append(res.get_json()['drinks'][0]['id'])
+        return ids
+
+    def test_pages_follow_the_cursor(self):
+        ids = self.add_drinks(5)
+
+        seen = []
+        cursor = None
+        while True:
+            query = '/drinks?limit=2' + ('' if cursor is None else '&cursor={}'.format(cursor))
+            data = self.client.get(query).get_json()
+            self.assertLessEqual(len(data['drinks']), 2)
+            seen.extend(drink['id'] for drink in data['drinks'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, ids)
+
+    def test_last_page_has_no_cursor(self):
+        ids = self.add_drinks(2)
+        data = self.client.get('/drinks?limit=2&cursor={}'.format(ids[0])).get_json()
+
+        self.assertEqual([drink['id'] for drink in data['drinks']], ids[1:])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_fields_select_columns(self):
+        self.add_drinks(1)
+        short = self.client.get('/drinks?fields=id,title').get_json()
+        long = self.client.get('/drinks-detail?fields=recipe',
+                               headers=self.auth()).get_json()
+
+        self.assertEqual(short['drinks'], [{'id': 1, 'title': 'drink 0'}])
+        self.assertEqual(long['drinks'], [{'recipe': recipe('coffee')}])
+
+    def test_422_sent_for_invalid_listing_arguments(self):
+        for query in ('limit=0', 'limit=101', 'limit=ten', 'cursor=abc',
+                      'fields=id,price'):
+            res = self.client.get('/drinks?' + query)
+
+            self.assertEqual(res.status_code, 422, query)
+            self.assertEqual(res.get_json()['success'], False)
+
+    def test_bulk_upsert_counts_created_updated_and_unchanged(self):
+        self.add_drinks(2)
+        res = self.client.put('/drinks/bulk', headers=self.auth(), json={'drinks': [
+            {'title': 'drink 0', 'recipe': recipe('coffee')},
+            {'title': 'drink 1', 'recipe': recipe('coffee', 'milk')},
+            {'title': 'mocha', 'recipe': recipe('coffee', 'chocolate')}]})
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['created'], data['updated'], data['unchanged']), (1, 1, 1))
+        titles = [drink['title'] for drink in self.client.get('/drinks').get_json()['drinks']]
+        self.assertEqual(titles, ['drink 0', 'drink 1', 'mocha'])
+
+    def test_422_sent_for_duplicate_bulk_titles(self):
+        res = self.client.put('/drinks/bulk', headers=self.auth(), json=[
+            {'title': 'mocha', 'recipe': recipe('coffee')},
+            {'title': 'mocha', 'recipe': recipe('milk')}])
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.client.get('/drinks').get_json()['drinks'], [])
+
+    def test_failed_write_is_rolled_back(self):
+        def write():
+            models.db.session.add(models.Drink(title='mocha', recipe=recipe('coffee')))
+            raise ValueError('invalid drink')
+
+        with api.app.app_context():
+            with self.assertRaises(ValueError):
+                models.writer.run(models.db.session, write)
+            self.assertEqual(models.Drink.query.count(), 0)
+
+    def test_restart_keeps_the_drinks(self):
+        ids = self.add_drinks(2)
+        with api.app.app_context():
+            models.db.session.remove()
+            # what src.api runs on every start
+            models.db_create_or_upgrade()
+
+        drinks = self.client.get('/drinks').get_json()['drinks']
+        self.assertEqual([drink['id'] for drink in drinks], ids)
+
+    def test_reset_db_empties_the_tables_and_bumps_the_version(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'coffee': 5})
+        self.order(drinkId)
+        with api.app.app_context():
+            api.orders.flush()
+            before = models.menu_version.value
+
+        result = api.app.test_cli_runner().invoke(args=['reset-db', '--yes'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('database reset', result.output)
+        with api.app.app_context():
+            self.assertEqual(models.Drink.query.count(), 0)
+            self.assertEqual(models.Order.query.count(), 0)
+            self.assertEqual(models.Inventory.query.count(), 0)
+            self.assertGreater(models.menu_version.value, before)
+        self.assertEqual(self.client.get('/drinks').get_json()['drinks'], [])
+
+    def search(self, query):
+        data = self.client.get('/drinks/search?' + query).get_json()
+        return [drink['title'] for drink in data['drinks']]
+
+    def test_search_matches_all_or_any_ingredient(self):
+        self.client.put('/drinks/bulk', headers=self.auth(), json=[
+            {'title': 'latte', 'recipe': recipe('Espresso', 'Oat  Milk')},
+            {'title': 'americano', 'recipe': recipe('espresso', 'water')},
+            {'title': 'tea', 'recipe': recipe('tea', 'oat milk')}])
+
+        self.assertEqual(self.search('ingredient=espresso&ingredient=oat milk'),
+                         ['latte'])
+        self.assertEqual(self.search('ingredient=water&ingredient=TEA&match=any'),
+                         ['americano', 'tea'])
+        self.assertEqual(self.search('ingredient=cocoa'), [])
+        self.assertEqual(self.client.get('/drinks/search?ingredient=tea&match=some')
+                         .status_code, 422)
+
+    def test_search_follows_drink_writes(self):
+        self.assertEqual(self.search('ingredient=milk'), [])
+        drinkId, = self.add_drinks(1, prefix='latte')
+        self.client.patch('/drinks/{}'.format(drinkId), headers=self.auth(),
+                          json={'recipe': recipe('coffee', 'milk')})
+        self.assertEqual(self.search('ingredient=milk'), ['latte 0'])
+
+        self.client.delete('/drinks/{}'.format(drinkId), headers=self.auth())
+        self.assertEqual(self.search('ingredient=milk'), [])
+
+    def test_search_sees_writes_of_other_workers(self):
+        self.search('ingredient=milk')
+        with api.app.app_context():
+            # the write of another worker: the version moves, no listener runs
+            models.writer.run(models.db.session, lambda: (
+                models.db.session.add(models.Drink(title='flat white',
+                                                   recipe=recipe('milk'))),
+                models.menu_version.increment(models.db.session)))
+
+        self.assertEqual(self.search('ingredient=milk'), ['flat white'])
+
+    def order(self, drinkId, quantity=1):
+        return self.client.post('/orders', headers=self.auth(),
+                                json={'drink_id': drinkId, 'quantity': quantity})
+
+    def restock(self, levels):
+        return self.client.patch('/inventory', headers=self.auth(),
+                                 json={'ingredients': levels})
+
+    def test_order_is_accepted_and_takes_stock(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'Coffee': 10})
+        res = self.order(drinkId, quantity=3)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(len(res.get_json()['order']), 32)
+        inventory = self.client.get('/inventory', headers=self.auth()).get_json()
+        self.assertEqual(inventory['inventory'], {'coffee': 7})
+
+    def test_409_sent_when_out_of_stock(self):
+        self.client.post('/drinks', headers=self.auth(), json={
+            'title': 'latte', 'recipe': recipe('coffee', 'milk')})
+        self.restock({'coffee': 5, 'milk': 1})
+        res = self.order(1, quantity=2)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['ingredients'], ['milk'])
+        # all or nothing: the coffee was not taken either
+        inventory = self.client.get('/inventory', headers=self.auth()).get_json()
+        self.assertEqual(inventory['inventory'], {'coffee': 5, 'milk': 1})
+
+    def test_restock_accepts_orders_again(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'coffee': 0})
+        self.assertEqual(self.order(drinkId).status_code, 409)
+
+        res = self.restock({'coffee': 2})
+        self.assertEqual(res.get_json()['inventory'], {'coffee': 2})
+        self.assertEqual(self.order(drinkId).status_code, 202)
+
+    def test_flush_writes_buffered_orders(self):
+        drinkId, = self.add_drinks(1)
+        references = [self.order(drinkId).get_json()['order'] for _ in range(3)]
+
+        with api.app.app_context():
+            api.orders.flush()
+            stored = [order.reference for order in models.Order.query.order_by(models.Order.id)]
+        self.assertEqual(stored, references)
+
+    def test_concurrent_orders_never_oversell(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'coffee': 10})
+        statuses = []
+
+        def order():
+            for _ in range(5):
+                statuses.append(self.order(drinkId).status_code)
+
+        threads = [threading.Thread(target=order) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses.count(202), 10)
+        self.assertEqual(statuses.count(409), 30)
+        inventory = self.client.get('/inventory', headers=self.auth()).get_json()
+        self.assertEqual(inventory['inventory'], {'coffee': 0})
+
+    def inventory_row(self, ingredient):
+        with api.app.app_context():
+            row = models.Inventory.query.get(ingredient)
+            return row.quantity, row.leased
+
+    def test_orders_take_stock_from_a_lease(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'coffee': 200})
+        with mock.patch('src.orders.lease_stock', wraps=orders.lease_stock) as lease:
+            for _ in range(orders.LEASE_SIZE):
+                self.assertEqual(self.order(drinkId).status_code, 202)
+
+        self.assertEqual(lease.call_count, 1)
+        # the leased parts, less what a checkpoint already reported sold
+        self.assertEqual(self.inventory_row('coffee')[0], 150)
+        inventory = self.client.get('/inventory', headers=self.auth()).get_json()
+        self.assertEqual(inventory['inventory'], {'coffee': 150})
+
+    def test_checkpoint_writes_sales_and_gives_idle_leases_back(self):
+        self.restock({'coffee': 200})
+        # no writer thread checkpointing on its own
+        pipeline = orders.OrderPipeline(api.app)
+        with api.app.app_context():
+            for _ in range(3):
+                pipeline.take({'coffee': 1})
+            pipeline.checkpoint()
+            self.assertEqual(self.inventory_row('coffee'), (150, 47))
+            # nothing sold since: the lease goes back
+            pipeline.checkpoint()
+            self.assertEqual(self.inventory_row('coffee'), (197, 0))
+
+    def test_workers_never_lease_more_than_is_left(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'coffee': orders.LEASE_SIZE + 10})
+        # another worker leasing from the same table
+        other = orders.OrderPipeline(api.app)
+        accepted = 0
+        with api.app.app_context():
+            for pipeline in (api.orders, other):
+                while True:
+                    try:
+                        pipeline.take({'coffee': 1})
+                    except orders.OutOfStock:
+                        break
+                    accepted += 1
+            other.checkpoint(release=True)
+
+        self.assertEqual(accepted, orders.LEASE_SIZE + 10)
+        inventory = self.client.get('/inventory', headers=self.auth()).get_json()
+        self.assertEqual(inventory['inventory'], {'coffee': 0})
+
+    def test_restock_counts_leases_of_other_workers(self):
+        self.restock({'coffee': 100})
+        other = orders.OrderPipeline(api.app)
+        with api.app.app_context():
+            other.take({'coffee': 1})
+        self.restock({'coffee': 20})
+
+        # the other worker holds 49 of the 20: nothing is left to lease
+        self.assertEqual(self.inventory_row('coffee'), (-30, 50))
+        with api.app.app_context():
+            other.checkpoint(release=True)
+        self.assertEqual(self.inventory_row('coffee'), (19, 0))
+
+    def test_422_sent_for_recipe_with_invalid_parts(self):
+        self.client.post('/drinks', headers=self.auth(), json={
+            'title': 'latte',
+            'recipe': [{'name': 'milk', 'color': 'white', 'parts': 'two'}]})
+
+        self.assertEqual(self.order(1).status_code, 422)
+
+    def post_drink(self, key, title='mocha', token=None):
+        headers = dict(self.auth(token), **{'Idempotency-Key': key})
+        return self.client.post('/drinks', headers=headers, json={
+            'title': title, 'recipe': recipe('coffee')})
+
+    def test_retry_with_same_key_is_replayed(self):
+        first = self.post_drink('key-1')
+        retry = self.post_drink('key-1')
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(len(self.client.get('/drinks').get_json()['drinks']), 1)
+
+    def test_409_sent_for_key_reused_with_other_body(self):
+        self.post_drink('key-1')
+        res = self.post_drink('key-1', title='latte')
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(res.get_json()['success'], False)
+
+    def test_422_sent_for_malformed_key(self):
+        for key in ('', 'k' * 256):
+            self.assertEqual(self.post_drink(key).status_code, 422)
+
+    def test_rejected_order_is_not_replayed(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'coffee': 0})
+        headers = dict(self.auth(), **{'Idempotency-Key': 'order-1'})
+        order = {'drink_id': drinkId}
+
+        self.assertEqual(self.client.post('/orders', headers=headers, json=order)
+                         .status_code, 409)
+        self.restock({'coffee': 1})
+        res = self.client.post('/orders', headers=headers, json=order)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def key_row(self, key, **values):
+        # the row another worker's request would have left
+        row = dict(caller='sub:local|manager', method='POST', path='/drinks', key=key,
+                   fingerprint='0' * 64, expires_at=time.time() + 60)
+        row.update(values)
+        with api.app.app_context():
+            models.db.session.add(models.IdempotencyKey(**row))
+            models.db.session.commit()
+
+    def test_key_is_stored_with_the_response(self):
+        self.post_drink('key-1')
+
+        with api.app.app_context():
+            row = models.IdempotencyKey.query.one()
+            self.assertEqual((row.caller, row.method, row.path, row.key, row.status),
+                             ('sub:local|manager', 'POST', '/drinks', 'key-1', 200))
+
+    def test_409_sent_while_another_worker_handles_the_key(self):
+        self.post_drink('key-1')
+        with api.app.app_context():
+            fingerprint = models.IdempotencyKey.query.one().fingerprint
+        self.key_row('key-2', fingerprint=fingerprint)
+
+        res = self.post_drink('key-2', title='mocha')
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(res.get_json()['message'],
+                         'a request with this Idempotency-Key is in progress')
+
+    def test_expired_key_is_handled_again(self):
+        self.key_row('key-1', status=200, body=b'{}', mimetype='application/json',
+                     expires_at=time.time() - 1)
+
+        res = self.post_drink('key-1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_failed_write_leaves_the_key_free(self):
+        self.post_drink('key-1')
+        self.assertEqual(self.post_drink('key-2').status_code, 400)
+
+        res = self.post_drink('key-2', title='latte')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_concurrent_retries_write_once(self):
+        statuses = []
+        threads = [threading.Thread(target=lambda: statuses.append(
+            self.post_drink('key-1').status_code)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(set(statuses) - {409}), [200])
+        self.assertEqual(len(self.client.get('/drinks').get_json()['drinks']), 1)
+
+    def test_retried_order_takes_stock_once(self):
+        drinkId, = self.add_drinks(1)
+        self.restock({'coffee': 1})
+        headers = dict(self.auth(), **{'Idempotency-Key': 'order-1'})
+        first = self.client.post('/orders', headers=headers, json={'drink_id': drinkId})
+        retry = self.client.post('/orders', headers=headers, json={'drink_id': drinkId})
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(self.order(drinkId).status_code, 409)
+
+    def test_callers_without_subject_do_not_share_keys(self):
+        def token():
+            now = int(time.time())
+            return jwt.encode({
+                'iss': issuer.issuer, 'aud': issuer.audience, 'iat': now,
+                'exp': now + 3600, 'jti': uuid.uuid4().hex,
+                'permissions': ['post:drinks']
+            }, issuer.privateKey, algorithm='RS256', headers={'kid': issuer.kid})
+
+        self.assertEqual(self.post_drink('key-1', token=token()).status_code, 200)
+        # same key and body from another caller: handled, not replayed
+        res = self.post_drink('key-1', token=token())
+
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class MenuStreamTestCase(unittest.TestCase):
+    """This class checks the menu change stream"""
+
+    def setUp(self):
+        with api.app.app_context():
+            models.db_drop_and_create_all()
+        self.client = api.app.test_client()
+        self.token = issuer.mint(PERMISSIONS, subject='local|manager')
+
+    def version(self):
+        with api.app.app_context():
+            return models.menu_version.value
+
+    def open(self, last_event_id=None):
+        with api.app.app_context():
+            stream = api.broadcaster.stream(last_event_id)
+        self.addCleanup(stream.close)
+        self.assertEqual(next(stream), 'retry: 3000\n\n')
+        return stream
+
+    def next_event(self, stream):
+        for message in stream:
+            if not message.startswith(':'):
+                eventId, kind, data = message.split('\n')[:3]
+                return int(eventId[len('id: '):]), json.loads(data[len('data: '):])
+
+    def add_drink(self, title):
+        self.client.post('/drinks', headers={'Authorization': 'Bearer ' + self.token},
+                         json={'title': title, 'recipe': recipe('coffee')})
+        return self.version()
+
+    def test_event_id_is_the_menu_version(self):
+        stream = self.open()
+        version = self.add_drink('latte')
+
+        self.assertEqual(self.next_event(stream),
+                         (version, {'type': 'changed', 'version': version}))
+
+    def test_writes_of_other_workers_reach_the_stream(self):
+        stream = self.open()
+        with api.app.app_context():
+            # the write of another worker: the version moves, no listener runs
+            version = models.writer.run(models.db.session, lambda: (
+                models.db.session.add(models.Drink(title='mocha', recipe=recipe('coffee'))),
+                models.menu_version.increment(models.db.session))[1])
+            models.db.session.remove()
+
+        self.assertEqual(self.next_event(stream)[0], version)
+
+    def test_resume_sends_the_latest_version(self):
+        first = self.add_drink('latte')
+        self.add_drink('mocha')
+        last = self.add_drink('tea')
+        # a client that saw the first drink reconnects, to any worker
+        stream = self.open(first)
+
+        self.assertEqual(self.next_event(stream),
+                         (last, {'type': 'changed', 'version': last}))
+
+    def test_reset_sent_for_last_event_id_ahead_of_the_menu(self):
+        version = self.version()
+        stream = self.open(version + 5)
+
+        self.assertEqual(self.next_event(stream),
+                         (version, {'type': 'reset', 'version': version}))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.request import urlopen
+
+from flask import Flask, jsonify
+
+from src.auth import auth, jwks as jwks_module
+from src.auth.auth import AuthError, requires_auth
+from src.auth.jwks import JWKSKeyStore, JWKSError
+from src.auth.local_issuer import LocalIssuer
+from src.auth.token_cache import VerifiedTokenCache
+
+CONCURRENT_REQUESTS = 16
+
+# signs tokens the default issuer and audience of auth.py accept
+issuer = LocalIssuer(auth.AUTH0_ISSUER, auth.API_AUDIENCE)
+
+
+def create_app():
+    app = Flask(__name__)
+
+    @app.route('/drinks-detail')
+    @requires_auth('get:drinks-detail')
+    def drinks_detail(payload):
+        return jsonify({'success': True, 'sub': payload['sub']})
+
+    @app.errorhandler(AuthError)
+    def auth_error(error):
+        return jsonify({
+            'success': False,
+            'error': error.status_code,
+            'message': error.error['description']
+        }), error.status_code
+
+    return app
+
+
+class CountingUrlopen:
+    '''
+    urlopen counting the downloads, each taking `delay` seconds
+    '''
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, url, timeout=None):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return urlopen(url, timeout=timeout)
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class checks the signing key cache against a file:// JWKS"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'jwks.json')
+        self.url = issuer.write_jwks(self.path)
+        self.store = JWKSKeyStore(self.url)
+        self.downloads = CountingUrlopen()
+        patcher = mock.patch.object(jwks_module, 'urlopen', self.downloads)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age(self, seconds):
+        # as if the last fetch happened `seconds` earlier
+        self.store.lastAttempt -= seconds
+        self.store.lastFinished -= seconds
+        self.store.fetchedAt -= seconds
+
+    def rotate(self, kid):
+        jwks = issuer.jwks()
+        jwks['keys'][0]['kid'] = kid
+        with open(self.path, 'w') as jwksFile:
+            json.dump(jwks, jwksFile)
+
+    def test_cold_cache_downloads_once(self):
+        self.downloads.delay = 0.2
+        keys = []
+        threads = [threading.Thread(target=lambda: keys.append(self.store.get_key('local')))
+                   for _ in range(CONCURRENT_REQUESTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.downloads.calls, 1)
+        self.assertEqual(len(keys), CONCURRENT_REQUESTS)
+        self.assertTrue(all(key['kid'] == 'local' for key in keys))
+
+    def test_unknown_kid_refetches_at_most_once_per_interval(self):
+        self.store.get_key('local')
+        self.rotate('rotated')
+
+        # right after a fetch an unknown key id does not fetch again
+        self.assertIsNone(self.store.get_key('rotated'))
+        self.assertEqual(self.downloads.calls, 1)
+
+        self.age(self.store.refetchInterval)
+        self.assertEqual(self.store.get_key('rotated')['kid'], 'rotated')
+        self.assertIsNone(self.store.get_key('made-up'))
+        self.assertEqual(self.downloads.calls, 2)
+
+    def test_expired_keys_are_served_while_revalidating(self):
+        self.store.get_key('local')
+        os.remove(self.path)
+        self.age(self.store.ttl + 1)
+
+        self.assertEqual(self.store.get_key('local')['kid'], 'local')
+        self.assertTrue(self.store.wakeUp.is_set() or self.downloads.calls > 1)
+
+    def test_fetch_failure_without_cached_keys(self):
+        os.remove(self.path)
+
+        with self.assertRaises(JWKSError):
+            self.store.get_key('local')
+
+    def test_unavailable_keys_answer_503(self):
+        os.remove(self.path)
+        token = issuer.mint(['get:drinks-detail'])
+
+        with mock.patch.object(auth, 'jwks', self.store):
+            res = create_app().test_client().get(
+                '/drinks-detail', headers={'Authorization': 'Bearer ' + token})
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.get_json()['success'], False)
+
+    def test_token_verified_with_file_keys(self):
+        token = issuer.mint(['get:drinks-detail'], subject='local|barista')
+
+        with mock.patch.object(auth, 'jwks', self.store):
+            res = create_app().test_client().get(
+                '/drinks-detail', headers={'Authorization': 'Bearer ' + token})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['sub'], 'local|barista')
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """This class checks the cache of verified tokens"""
+
+    def setUp(self):
+        self.cache = VerifiedTokenCache(maxsize=2)
+        self.expires = time.time() + 3600
+
+    def payload(self, permissions=('get:drinks-detail',)):
+        return {'sub': 'local|barista', 'exp': self.expires,
+                'permissions': list(permissions)}
+
+    def test_hit_returns_verified_token(self):
+        self.cache.put('token', self.payload())
+        verified = self.cache.get('token')
+
+        self.assertEqual(verified.payload['sub'], 'local|barista')
+        self.assertEqual(verified.permissions, frozenset(['get:drinks-detail']))
+        self.assertIsNone(self.cache.get('other token'))
+
+    def test_repeated_token_is_verified_once(self):
+        token = issuer.mint(['get:drinks-detail'])
+        with mock.patch.object(auth, 'verifiedTokens', self.cache), \
+                mock.patch.object(auth, 'verify_decode_jwt',
+                                  return_value=self.payload()) as verify:
+            auth.verify_token(token)
+            auth.verify_token(token)
+
+        self.assertEqual(verify.call_count, 1)
+
+    def test_entry_expires_at_exp(self):
+        self.cache.put('token', self.payload())
+
+        with mock.patch('src.auth.token_cache.time.time', return_value=self.expires - 1):
+            self.assertIsNotNone(self.cache.get('token'))
+        with mock.patch('src.auth.token_cache.time.time', return_value=self.expires):
+            self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_token_without_exp_is_not_cached(self):
+        payload = self.payload()
+        del payload['exp']
+        self.cache.put('token', payload)
+
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('first', self.payload())
+        self.cache.put('second', self.payload())
+        self.cache.get('first')
+        self.cache.put('third', self.payload())
+
+        self.assertIsNotNone(self.cache.get('first'))
+        self.assertIsNone(self.cache.get('second'))
+        self.assertIsNotNone(self.cache.get('third'))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,284 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from src.database.models import db, setup_db, db_create_or_upgrade, writer, \
+    menu_version, sqlite_profile, Drink, Inventory
+from src.database.migrations import upgrade, SCHEMA_VERSION
+from src.menu import MenuCache
+
+THREADS = 16
+READERS = 8
+WORKERS = 4
+DRINKS_PER_WRITER = 20
+
+
+def create_app(path):
+    app = Flask(__name__)
+    setup_db(app, path)
+    return app
+
+
+def recipe(number):
+    return [{'name': 'coffee', 'color': 'brown', 'parts': number % 5 + 1}]
+
+
+def write_drinks(app, prefix, errors):
+    try:
+        with app.app_context():
+            for number in range(DRINKS_PER_WRITER):
+                drink = Drink(title='{}-{}'.format(prefix, number),
+                              recipe=recipe(number))
+                drink.insert()
+                drink.recipe = recipe(number + 1)
+                drink.update()
+            db.session.remove()
+    except Exception as e:
+        errors.append(repr(e))
+
+
+def worker_process(path, prefix, errors):
+    failures = []
+    write_drinks(create_app(path), prefix, failures)
+    errors.extend(failures)
+
+
+class SQLiteConcurrencyTestCase(unittest.TestCase):
+    """This class checks concurrent access to the SQLite database"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = 'sqlite:///{}'.format(os.path.join(self.directory, 'test.db'))
+        self.app = create_app(self.path)
+        with self.app.app_context():
+            db_create_or_upgrade()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        shutil.rmtree(self.directory)
+
+    def count_drinks(self):
+        with self.app.app_context():
+            return Drink.query.count()
+
+    def test_profile_enables_wal(self):
+        with self.app.app_context():
+            journal = db.session.execute('PRAGMA journal_mode').scalar()
+            timeout = db.session.execute('PRAGMA busy_timeout').scalar()
+
+        self.assertEqual(journal, 'wal')
+        self.assertEqual(timeout, 5000)
+
+    def test_threads_write_and_read_concurrently(self):
+        errors = []
+        done = threading.Event()
+        reads = []
+
+        def read():
+            with self.app.app_context():
+                while not done.is_set():
+                    try:
+                        reads.append(len(Drink.query.all()))
+                    except Exception as e:
+                        errors.append(repr(e))
+                    db.session.remove()
+                    time.sleep(0.001)
+
+        writers = [threading.Thread(target=write_drinks,
+                                    args=(self.app, 'thread{}'.format(number), errors))
+                   for number in range(THREADS)]
+        readers = [threading.Thread(target=read) for _ in range(READERS)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertGreater(len(reads), 0)
+        self.assertEqual(self.count_drinks(), THREADS * DRINKS_PER_WRITER)
+
+    def test_more_threads_than_pooled_connections(self):
+        errors = []
+        handler = logging.Handler(logging.ERROR)
+        handler.emit = lambda record: errors.append(record.getMessage())
+        logging.getLogger('sqlalchemy.pool').addHandler(handler)
+        try:
+            with mock.patch.dict(sqlite_profile, pool_size=2):
+                app = create_app(self.path)
+            # a thread per request, like the development server
+            threads = [threading.Thread(target=write_drinks,
+                                        args=(app, 'request{}'.format(number), errors))
+                       for number in range(THREADS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with app.app_context():
+                db.get_engine(app).dispose()
+        finally:
+            logging.getLogger('sqlalchemy.pool').removeHandler(handler)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.count_drinks(), THREADS * DRINKS_PER_WRITER)
+
+    def test_worker_processes_write_concurrently(self):
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager:
+            errors = manager.list()
+            workers = [context.Process(target=worker_process,
+                                       args=(self.path, 'worker{}'.format(number), errors))
+                       for number in range(WORKERS)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            errors = list(errors)
+
+        self.assertEqual(errors, [])
+        self.assertEqual([worker.exitcode for worker in workers], [0] * WORKERS)
+        self.assertEqual(self.count_drinks(), WORKERS * DRINKS_PER_WRITER)
+
+
+class MenuVersionTestCase(unittest.TestCase):
+    """This class checks that menu caches see writes of other workers"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = 'sqlite:///{}'.format(os.path.join(self.directory, 'test.db'))
+        self.app = create_app(self.path)
+        with self.app.app_context():
+            db_create_or_upgrade()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        shutil.rmtree(self.directory)
+
+    def write_from_other_worker(self, title):
+        # another worker has its own engine and its own listeners
+        engine = create_engine(self.path)
+        session = Session(bind=engine)
+        try:
+            return writer.commit(session, Drink(title=title, recipe=recipe(1)),
+                                 'insert', menu_version.increment)
+        finally:
+            session.close()
+            engine.dispose()
+
+    def test_versions_are_shared_through_the_database(self):
+        with self.app.app_context():
+            self.assertEqual(menu_version.value, 0)
+            Drink(title='latte', recipe=recipe(1)).insert()
+            self.assertEqual(menu_version.value, 1)
+            db.session.remove()
+
+        self.assertEqual(self.write_from_other_worker('mocha'), 2)
+        with self.app.app_context():
+            self.assertEqual(menu_version.value, 2)
+
+    def test_cache_sees_writes_of_other_workers(self):
+        cache = MenuCache()
+        with self.app.app_context():
+            etag, body = cache.get('short')
+            db.session.remove()
+
+        self.write_from_other_worker('mocha')
+        with self.app.app_context():
+            newEtag, newBody = cache.get('short')
+
+        self.assertNotEqual(newEtag, etag)
+        self.assertIn(b'mocha', newBody)
+
+
+class MigrationTestCase(unittest.TestCase):
+    """This class checks the upgrade of a database of the original schema"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = 'sqlite:///{}'.format(os.path.join(self.directory, 'test.db'))
+        # version 0: recipes are TEXT and there is no short_recipe
+        engine = create_engine(self.path)
+        with engine.begin() as connection:
+            connection.execute('CREATE TABLE drink (id INTEGER NOT NULL, '
+                               'title VARCHAR(80), recipe VARCHAR(180) NOT NULL, '
+                               'PRIMARY KEY (id), UNIQUE (title))')
+            connection.execute(
+                'INSERT INTO drink (id, title, recipe) VALUES (?, ?, ?), (?, ?, ?)',
+                (1, 'water', '{"name": "water", "color": "blue", "parts": 1}',
+                 2, 'latte', '[{"name": "milk", "color": "grey", "parts": 3}, '
+                             '{"name": "coffee", "color": "brown", "parts": 1}]'))
+        engine.dispose()
+        self.app = create_app(self.path)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        shutil.rmtree(self.directory)
+
+    def user_version(self):
+        return db.session.execute('PRAGMA user_version').scalar()
+
+    def test_text_recipes_become_json_with_short_recipe(self):
+        with self.app.app_context():
+            self.assertEqual(self.user_version(), 0)
+            db_create_or_upgrade()
+            db.session.remove()
+
+            self.assertEqual(self.user_version(), SCHEMA_VERSION)
+            water, latte = Drink.query.order_by(Drink.id).all()
+            self.assertEqual(water.recipe, [{'name': 'water', 'color': 'blue', 'parts': 1}])
+            self.assertEqual(water.short_recipe, [{'color': 'blue', 'parts': 1}])
+            self.assertEqual(latte.recipe[0]['name'], 'milk')
+            self.assertEqual(latte.short_recipe, [{'color': 'grey', 'parts': 3},
+                                                  {'color': 'brown', 'parts': 1}])
+
+    def test_inventory_gains_leased_parts(self):
+        with self.app.app_context():
+            # the inventory of version 1, before stock was leased
+            db.session.execute('CREATE TABLE inventory (ingredient VARCHAR(80) NOT NULL, '
+                               'quantity FLOAT NOT NULL, PRIMARY KEY (ingredient))')
+            db.session.execute("INSERT INTO inventory VALUES ('milk', 12)")
+            db.session.commit()
+            db_create_or_upgrade()
+            db.session.remove()
+
+            milk = Inventory.query.get('milk')
+            self.assertEqual((milk.quantity, milk.leased), (12, 0))
+
+    def test_second_upgrade_does_nothing(self):
+        with self.app.app_context():
+            db_create_or_upgrade()
+            db.session.remove()
+            before = db.session.execute(
+                'SELECT id, recipe, short_recipe FROM drink ORDER BY id').fetchall()
+            db.session.remove()
+
+            self.assertEqual(upgrade(db.engine), [])
+            db_create_or_upgrade()
+            db.session.remove()
+            after = db.session.execute(
+                'SELECT id, recipe, short_recipe FROM drink ORDER BY id').fetchall()
+            self.assertEqual(self.user_version(), SCHEMA_VERSION)
+        self.assertEqual(after, before)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()